@@ -9,6 +9,8 @@ import numpy as np
 
 import rospy
 import utils as Utils
+from KinematicKernel import KinematicKernel
+from NoisePool import NoisePool
 from nav_msgs.msg import Odometry
 from std_msgs.msg import Float64
 from vesc_msgs.msg import VescStateStamped
@@ -24,6 +26,14 @@ KM_X_FIX_NOISE = .025 # Kinematic car x position constant noise std dev
 KM_Y_FIX_NOISE = .025 #2 Kinematic car y position constant noise std dev
 KM_THETA_FIX_NOISE = .01 # Kinematic car theta constant noise std dev
 
+NOISE_POOL_MIN_BLOCK = 1 << 20 # Fewest normals in each block of the noise pool
+NOISE_POOL_MSGS_PER_BLOCK = 10 # Number of vesc state msgs that each block of the noise pool lasts for
+
+COALESCE_V_TOL = 0.05 # Max difference in m/s between the speed of a vesc state msg and the segment it is merged into
+COALESCE_DELTA_TOL = 0.01 # Max difference in radians between the steering angle of a vesc state msg and the segment it is merged into
+COALESCE_MAX_DT = 0.25 # Max duration in seconds of a segment, longer arcs are not approximated well by one noise draw
+COALESCE_MAX_SEGMENTS = 50 # Pending segments are applied right away once there are this many
+
 '''
   Propagates the particles forward based on the velocity and steering angle of the car
 '''
@@ -40,10 +50,16 @@ class KinematicMotionModel:
       car_length: The length of the car
       particles: The particles to propagate forward
       state_lock: Controls access to particles
+      noise_seed: Seed of the motion noise, None to seed from the OS
+      coalesce: Whether to merge vesc state msgs into segments that are only applied to the particles
+                when flush is called, instead of applying every msg right away
+      flush_rate: Rate in Hz at which pending segments are applied in coalesce mode, 0 to only apply them
+                  when flush is called
   '''
   def __init__(self, motor_state_topic, servo_state_topic, speed_to_erpm_offset,
                speed_to_erpm_gain, steering_to_servo_offset,
-               steering_to_servo_gain, car_length, particles, state_lock=None):
+               steering_to_servo_gain, car_length, particles, state_lock=None,
+               noise_seed=None, coalesce=False, flush_rate=0.0):
     self.last_servo_cmd = None # The most recent servo command
     self.last_vesc_stamp = None # The time stamp from the previous vesc state msg
     self.particles = particles
@@ -52,6 +68,19 @@ class KinematicMotionModel:
     self.STEERING_TO_SERVO_OFFSET = steering_to_servo_offset # Offset conversion param from servo position to steering angle
     self.STEERING_TO_SERVO_GAIN = steering_to_servo_gain # Gain conversion param from servo position to steering angle
     self.CAR_LENGTH = car_length # The length of the car
+    self.accum_translation = 0.0 # Distance in meters that the car travelled since the last reset_motion
+    self.accum_rotation = 0.0 # Absolute change of heading in radians since the last reset_motion
+    self.last_vesc_seq = None # The sequence number of the previous vesc state msg
+    self.n_motion_msgs = 0 # Number of vesc state msgs that were applied to the particles
+    self.n_applied = 0 # Number of times that motion was applied to the particles, lets other code notice that copies of a particle moved apart
+    self.n_dropped = 0 # Number of vesc state msgs that never reached motion_cb, from gaps in the sequence numbers
+    self.noise = None # Preallocated (5,N) buffer of the speed, delta, x, y and theta noise of each particle
+    # Pre-generates the motion noise on a background thread, five normals per particle per msg
+    self.noise_pool = NoisePool(max(NOISE_POOL_MIN_BLOCK, 5 * NOISE_POOL_MSGS_PER_BLOCK * particles.shape[0]), noise_seed)
+    self.kernel = KinematicKernel(car_length) # Propagates the particles in place without allocating
+    self.COALESCE = coalesce # Whether to merge vesc state msgs into segments instead of applying them right away
+    self.segments = [] # Pending [speed, steering angle, duration, number of msgs] segments in coalesce mode
+    self.n_flushed_segments = 0 # Number of segments that were applied to the particles in coalesce mode
 
     # This just ensures that two different threads are not changing the particles
     # array at the same time. You should not have to deal with this.
@@ -66,6 +95,11 @@ class KinematicMotionModel:
     # Subscribe to the state of the vesc
     self.motion_sub = rospy.Subscriber(motor_state_topic, VescStateStamped, self.motion_cb, queue_size=1)
 
+    # Keeps the particles from lagging behind by more than 1/flush_rate seconds between laser scans
+    self.flush_timer = None
+    if self.COALESCE and flush_rate > 0:
+      self.flush_timer = rospy.Timer(rospy.Duration(1.0 / flush_rate), self.flush_cb)
+
   '''
     Caches the most recent servo command
       msg: A std_msgs/Float64 message
@@ -82,6 +116,10 @@ class KinematicMotionModel:
   '''
   def motion_cb(self, msg):
     self.state_lock.acquire()
+    if self.last_vesc_seq is not None and msg.header.seq > self.last_vesc_seq:
+      self.n_dropped += msg.header.seq - self.last_vesc_seq - 1
+    self.last_vesc_seq = msg.header.seq
+
     if self.last_servo_cmd is None:
       self.state_lock.release()
       return
@@ -111,70 +149,123 @@ class KinematicMotionModel:
     curr_delta = (self.last_servo_cmd - self.STEERING_TO_SERVO_OFFSET)/self.STEERING_TO_SERVO_GAIN
 
 
+    #Calculate the Kinematic Model additions
+    deltaTDuration = msg.header.stamp - self.last_vesc_stamp
+    deltaT = deltaTDuration.to_sec()
+
+    # Accumulate the noise free motion so that the sensor model can skip updates while the car is still
+    self.accum_translation += abs(curr_speed) * deltaT
+    self.accum_rotation += abs(curr_speed / self.CAR_LENGTH * np.sin(2 * np.arctan(np.tan(curr_delta) * 0.5))) * deltaT
+
+    if self.COALESCE:
+      self.add_segment(curr_speed, curr_delta, deltaT)
+    else:
+      self.apply_controls(curr_speed, curr_delta, deltaT, 1)
+
+    self.last_vesc_stamp = msg.header.stamp
+    self.n_motion_msgs += 1
+    self.state_lock.release()
+
+  '''
+    Applies controls to the particles with freshly sampled noise. The caller should hold state_lock
+      speed: The speed of the car
+      delta: The steering angle of the car
+      dt: The duration in seconds that the controls were applied for
+      n_msgs: The number of vesc state msgs that the controls were merged from. The noise is scaled so
+              that its variance matches applying each msg with independent noise: the fixed noise of
+              n_msgs msgs adds up, while the control noise averages out
+  '''
+  def apply_controls(self, speed, delta, dt, n_msgs):
+    # Noise is drawn from the pool into buffers that are reused for every msg
+    if self.noise is None or self.noise.shape[1] != self.particles.shape[0]:
+      self.noise = np.zeros((5, self.particles.shape[0]))
+    control_scale = 1.0 / np.sqrt(n_msgs)
+    fix_scale = np.sqrt(n_msgs)
+
     #Create the noisy speed and delta arrays
-    noisy_speed_array = np.random.normal(curr_speed, KM_V_NOISE, len(self.particles))
-    noisy_delta_array = np.random.normal(curr_delta, KM_DELTA_NOISE, len(self.particles))
+    noisy_speed_array = self.noise_pool.normal(speed, KM_V_NOISE * control_scale, self.noise[0])
+    noisy_delta_array = self.noise_pool.normal(delta, KM_DELTA_NOISE * control_scale, self.noise[1])
 
     #Create the noisy position and rotation arrays
-    noisy_KM_x = np.random.normal(0, KM_X_FIX_NOISE, len(self.particles))
-    noisy_KM_y = np.random.normal(0, KM_Y_FIX_NOISE, len(self.particles))
-    noisy_KM_theta = np.random.normal(0, KM_THETA_FIX_NOISE, len(self.particles))
+    noisy_KM_x = self.noise_pool.normal(0, KM_X_FIX_NOISE * fix_scale, self.noise[2])
+    noisy_KM_y = self.noise_pool.normal(0, KM_Y_FIX_NOISE * fix_scale, self.noise[3])
+    noisy_KM_theta = self.noise_pool.normal(0, KM_THETA_FIX_NOISE * fix_scale, self.noise[4])
 
-    # noisy_KM_x = 0
-    # noisy_KM_y = 0
-    # noisy_KM_theta = 0
+    # Propagate the model forward, add noise and wrap theta. Overwrites the noisy controls
+    self.kernel.propagate(self.particles, noisy_speed_array, noisy_delta_array, dt,
+                          noisy_KM_x, noisy_KM_y, noisy_KM_theta)
+    self.n_applied += 1
 
-    #Calculate the Kinematic Model additions
-    deltaTDuration = msg.header.stamp - self.last_vesc_stamp
-    deltaT = deltaTDuration.to_sec()
-    beta = np.arctan(np.tan(noisy_delta_array) * 0.5 )
-    KM_theta = noisy_speed_array/self.CAR_LENGTH*np.sin(2*beta)*deltaT
-    assert np.any((KM_theta <= 2*np.pi, KM_theta >= 0.0)), "KM_theta is not within the range [0, 2*pi]"
-
-    # KM_theta =  np.remainder( (KM_theta_2pi + np.full((len(KM_theta_2pi),1), np.pi)), np.full((len(KM_theta_2pi),1), 2*np.pi) ) - np.full((len(KM_theta_2pi),1), np.pi)
-
-    KM_X = self.CAR_LENGTH/np.sin(2*beta)*(np.sin(self.particles[:,2] + KM_theta)-np.sin(self.particles[:,2]))
-    KM_Y = self.CAR_LENGTH/np.sin(2*beta)*(-np.cos(self.particles[:,2] + KM_theta)+np.cos(self.particles[:,2]))
-
-    # rospy.loginfo("This is the current speed")
-    # rospy.loginfo(curr_speed)
-    # rospy.loginfo("This is the current steering angle, delta")
-    # rospy.loginfo(curr_delta)
-    # rospy.loginfo("This is the average noisy speed")
-    # rospy.loginfo(np.mean(noisy_speed_array))
-    # rospy.loginfo("This is the average noisy delta")
-    # rospy.loginfo(np.mean(noisy_delta_array))
-    # rospy.loginfo("This is delta T time step")
-    # rospy.loginfo(deltaT)
-    # rospy.loginfo("This is the average beta")
-    # rospy.loginfo(np.mean(beta))
-    # rospy.loginfo("This is the average KM_X")
-    # rospy.loginfo(np.mean(KM_X))
-    # rospy.loginfo("This is the average KM_X")
-    # rospy.loginfo(np.mean(KM_X))
-    # rospy.loginfo("This is the average KM_Y")
-    # rospy.loginfo(np.mean(KM_Y))
-    # rospy.loginfo("This is the average KM_theta")
-    # rospy.loginfo(np.mean(KM_theta))
-    # rospy.loginfo("\n")
-
-
-    #Propogate the model forward and add noise
-    self.particles[:,0] = self.particles[:,0] + KM_X + noisy_KM_x
-    self.particles[:,1] = self.particles[:,1] + KM_Y + noisy_KM_y
-    self.particles[:,2] = self.particles[:,2] + KM_theta + noisy_KM_theta
-
-    # rospy.loginfo("This is the average X position of particles")
-    # rospy.loginfo(np.mean(self.particles[:,0]))
-    # rospy.loginfo("This is the average Y position of particles")
-    # rospy.loginfo(np.mean(self.particles[:,1]))
-    # rospy.loginfo("This is the average Theta position of particles")
-    # rospy.loginfo(np.mean(self.particles[:,2]))
-    # rospy.loginfo("\n")
-  
-    self.last_vesc_stamp = msg.header.stamp
+  '''
+    Merges controls into the last pending segment if they are close enough to its controls,
+    otherwise starts a new segment. The caller should hold state_lock
+      speed: The speed of the car
+      delta: The steering angle of the car
+      dt: The duration in seconds that the controls were applied for
+  '''
+  def add_segment(self, speed, delta, dt):
+    if len(self.segments) > 0:
+      segment = self.segments[-1]
+      if (abs(segment[0] - speed) <= COALESCE_V_TOL and abs(segment[1] - delta) <= COALESCE_DELTA_TOL and
+          segment[2] + dt <= COALESCE_MAX_DT):
+        # Average the controls over the duration of the segment
+        total_dt = segment[2] + dt
+        if total_dt > 0:
+          segment[0] = (segment[0] * segment[2] + speed * dt) / total_dt
+          segment[1] = (segment[1] * segment[2] + delta * dt) / total_dt
+        segment[2] = total_dt
+        segment[3] += 1
+        return
+
+    self.segments.append([speed, delta, dt, 1])
+    if len(self.segments) >= COALESCE_MAX_SEGMENTS:
+      self.flush()
+
+  '''
+    Applies the pending segments to the particles. Does nothing unless in coalesce mode.
+    The caller should hold state_lock
+  '''
+  def flush(self):
+    for speed, delta, dt, n_msgs in self.segments:
+      self.apply_controls(speed, delta, dt, n_msgs)
+    self.n_flushed_segments += len(self.segments)
+    del self.segments[:]
+
+  '''
+    Drops the pending segments, e.g. because the particles were reinitialized. The caller should hold state_lock
+  '''
+  def clear_segments(self):
+    del self.segments[:]
+
+  '''
+    Applies the pending segments on a timer
+      event: A rospy.TimerEvent
+  '''
+  def flush_cb(self, event):
+    self.state_lock.acquire()
+    self.flush()
     self.state_lock.release()
 
+  '''
+    Returns whether the car travelled at least min_d meters or turned at least min_a radians
+    since the last call to reset_motion. The caller should hold state_lock
+      min_d: Translation threshold in meters
+      min_a: Rotation threshold in radians
+  '''
+  def has_moved(self, min_d, min_a):
+    return self.accum_translation >= min_d or self.accum_rotation >= min_a
+
+  '''
+    Restarts accumulating motion from the motion that a sensor update accounted for, so that
+    motion made while the update was being computed still counts toward the next one.
+    The caller should hold state_lock
+      translation: The accumulated translation when the sensor update took its snapshot
+      rotation: The accumulated rotation when the sensor update took its snapshot
+  '''
+  def reset_motion(self, translation, rotation):
+    self.accum_translation = max(self.accum_translation - translation, 0.0)
+    self.accum_rotation = max(self.accum_rotation - rotation, 0.0)
+
 '''
   Code for testing motion model
 '''
@@ -8,7 +8,7 @@ import time
 import utils as Utils
 import tf.transformations
 import tf
-from threading import Lock
+from threading import Condition, Lock, Thread
 
 from nav_msgs.srv import GetMap
 from geometry_msgs.msg import PoseStamped, PoseArray, PoseWithCovarianceStamped, PointStamped
@@ -18,10 +18,14 @@ from nav_msgs.msg import Odometry
 from ReSample import ReSampler
 from SensorModel import SensorModel
 from MotionModel import KinematicMotionModel
+from PoseEstimate import weighted_mean_pose, clustered_pose
 
 MAP_TOPIC = "static_map"
 PUBLISH_PREFIX = '/pf/viz'
 PUBLISH_TF = True
+CLICKED_POSE_XY_STD = .005 # Std dev in map pixels of the position of particles sampled around a clicked pose
+CLICKED_POSE_THETA_STD = 0.05 # Std dev in radians of the heading of particles sampled around a clicked pose
+CLICKED_POSE_MAX_ROUNDS = 100 # Number of times that particles outside of the permissible region are redrawn
 
 '''
   Implements particle filtering for estimating the state of the robot car
@@ -39,26 +43,63 @@ class ParticleFilter():
     laser_ray_step: Step for downsampling laser scans
     exclude_max_range_rays: Whether to exclude rays that are beyond the max range
     max_range_meters: The max range of the laser
-    resample_type: Whether to use naiive or low variance sampling
+    resample_type: Whether to use naiive, low variance, stratified, residual or KLD sampling
     speed_to_erpm_offset: Offset conversion param from rpm to speed
     speed_to_erpm_gain: Gain conversion param from rpm to speed
     steering_angle_to_servo_offset: Offset conversion param from servo position to steering angle
     steering_angle_to_servo_gain: Gain conversion param from servo position to steering angle
     car_length: The length of the car
+    range_method_type: The ray casting backend used by the sensor model
+    sensor_model_type: Whether to use the beam or likelihood field sensor model
+    range_cache_size: Number of expected range vectors the sensor model memoizes, 0 disables the cache
+    cascade_fraction: Fraction of the particles the sensor model rescores with every ray, 0 disables the cascade
+    beam_budget: Number of informative rays the sensor model selects per scan, 0 uses laser_ray_step instead
+    update_min_d: Translation in meters required before a sensor update
+    update_min_a: Rotation in radians required before a sensor update
+    log_likelihood: Whether the sensor model sums log-probabilities instead of multiplying probabilities
+    n_workers: Number of threads that the sensor update is sharded across, only used by the numpy and lut range methods
+    noise_seed: Seed of the motion model noise, None to seed from the OS
+    coalesce_motion: Whether the motion model merges vesc state msgs into segments that are applied before each sensor update
+    motion_flush_rate: Rate in Hz at which coalesced motion is also applied between sensor updates, 0 to disable
+    resample_ess_fraction: Only resample once the effective sample size falls below this fraction of
+                           the number of particles, 1 resamples after every sensor update
+    kld_min_particles: The fewest particles that KLD sampling keeps
+    kld_max_particles: The most particles that KLD sampling keeps, the filter starts out with this many
+    pose_cluster_size: Size in meters of the grid cells that particles are clustered in to publish the
+                       mean of the heaviest cluster, 0 publishes the mean of every particle
+    viz_rate: Max rate in Hz at which a separate thread publishes the particles and the laser scan, 0 publishes them
+              from the thread that calls visualize
   '''
   def __init__(self, n_particles, n_viz_particles,
                motor_state_topic, servo_state_topic, scan_topic, laser_ray_step,
                exclude_max_range_rays, max_range_meters, resample_type,
                speed_to_erpm_offset, speed_to_erpm_gain, steering_angle_to_servo_offset,
-               steering_angle_to_servo_gain, car_length):
+               steering_angle_to_servo_gain, car_length, range_method_type='cddt', sensor_model_type='beam',
+               range_cache_size=0, cascade_fraction=0.0, beam_budget=0,
+               update_min_d=0.0, update_min_a=0.0, log_likelihood=False,
+               n_workers=1, noise_seed=None, coalesce_motion=False, motion_flush_rate=0.0,
+               resample_ess_fraction=1.0, kld_min_particles=100, kld_max_particles=5000,
+               pose_cluster_size=0.0, viz_rate=0.0):
+    if resample_type == 'kld':
+      n_particles = kld_max_particles # Start out with enough particles to cover the map
     self.N_PARTICLES = n_particles # The number of particles
-                                   # In this implementation, the total number of
-                                   # particles is constant
+                                   # The total number of particles is constant unless
+                                   # KLD sampling resizes the particles
     self.N_VIZ_PARTICLES = n_viz_particles # The number of particles to visualize
+    self.POSE_CLUSTER_SIZE = pose_cluster_size # Size of the grid cells that particles are clustered in for the expected pose, 0 disables clustering
 
+    # KLD sampling changes the number of particles, so the particles and weights are views of the
+    # first N_PARTICLES rows of buffers that are large enough for the most particles there can be
+    self.particle_buffer = np.zeros((max(n_particles, kld_max_particles),3))
+    self.weight_buffer = np.zeros(self.particle_buffer.shape[0])
     self.particle_indices = np.arange(self.N_PARTICLES) # Cached list of particle indices
-    self.particles = np.zeros((self.N_PARTICLES,3)) # Numpy matrix of dimension N_PARTICLES x 3
-    self.weights = np.ones(self.N_PARTICLES) / float(self.N_PARTICLES) # Numpy matrix containig weight for each particle
+    self.particles = self.particle_buffer[:self.N_PARTICLES] # Numpy matrix of dimension N_PARTICLES x 3
+    self.weights = self.weight_buffer[:self.N_PARTICLES] # Numpy matrix containig weight for each particle
+    self.weights.fill(1.0 / self.N_PARTICLES)
+    self.pose_particles = np.zeros_like(self.particle_buffer) # Snapshot of the particles that the published pose is computed from
+    self.pose_weights = np.zeros_like(self.weight_buffer) # Snapshot of the weights that the published pose is computed from
+    self.viz_particles = np.zeros_like(self.particle_buffer) # Snapshot of the particles that the visualization is computed from
+    self.viz_weights = np.zeros_like(self.weight_buffer) # Snapshot of the weights that the visualization is computed from
 
     self.state_lock = Lock() # A lock used to prevent concurrency issues. You do not need to worry about this
 
@@ -90,24 +131,59 @@ class ParticleFilter():
     self.pub_laser     = rospy.Publisher(PUBLISH_PREFIX + "/scan", LaserScan, queue_size = 1) # Publishes the most recent laser scan
     self.pub_odom      = rospy.Publisher(PUBLISH_PREFIX + "/odom", Odometry, queue_size = 1) # Publishes the path of the car
 
-    self.RESAMPLE_TYPE = resample_type # Whether to use naiive or low variance sampling
-    self.resampler = ReSampler(self.particles, self.weights, self.state_lock)  # An object used for resampling
-
-    # An object used for applying sensor model
-    self.sensor_model = SensorModel(scan_topic, laser_ray_step, exclude_max_range_rays,
-                                    max_range_meters, map_msg, self.particles, self.weights,
-                                    self.state_lock)
-
     # An object used for applying kinematic motion model
     self.motion_model = KinematicMotionModel(motor_state_topic, servo_state_topic,
                                              speed_to_erpm_offset, speed_to_erpm_gain,
                                              steering_angle_to_servo_offset, steering_angle_to_servo_gain,
-                                             car_length, self.particles, self.state_lock)
+                                             car_length, self.particles, self.state_lock, noise_seed,
+                                             coalesce_motion, motion_flush_rate)
+
+    self.RESAMPLE_TYPE = resample_type # Whether to use naiive, low variance, stratified, residual or KLD sampling
+    self.resampler = ReSampler(self.particles, self.weights, self.state_lock, kld_min_particles,
+                               self.particle_buffer.shape[0], self.resize_particles,
+                               self.motion_model)  # An object used for resampling
+
+    # An object used for applying sensor model
+    self.sensor_model = SensorModel(scan_topic, laser_ray_step, exclude_max_range_rays,
+                                    max_range_meters, map_msg, self.particles, self.weights,
+                                    self.state_lock, range_method_type, sensor_model_type,
+                                    range_cache_size, cascade_fraction, beam_budget,
+                                    self.motion_model, update_min_d, update_min_a, self.resampler,
+                                    log_likelihood, n_workers, resample_ess_fraction)
 
     # Subscribe to the '/initialpose' topic. Publised by RVIZ. See clicked_pose_cb function in this file for more info
     self.pose_sub  = rospy.Subscriber("/initialpose", PoseWithCovarianceStamped, self.clicked_pose_cb, queue_size=1)
+
+    # Publish the particles and the laser scan from a separate thread, so that the pose is not
+    # held up by them
+    self.VIZ_RATE = viz_rate # Max rate in Hz at which the visualization thread publishes, 0 disables the thread
+    self.viz_cond = Condition() # Notified when visualize is called or on shutdown, guards self.viz_pending and self.viz_shutdown
+    self.viz_pending = False # Set when the filter changed since the visualization was last published
+    self.viz_shutdown = False # Set on ROS shutdown so that the visualization thread exits
+    self.viz_thread = None
+    if self.VIZ_RATE > 0.0:
+      rospy.on_shutdown(self.viz_shutdown_cb)
+      self.viz_thread = Thread(target=self.viz_loop)
+      self.viz_thread.daemon = True
+      self.viz_thread.start()
     print('Initialization complete')
 
+  '''
+    Changes the number of particles, which become the first n_particles rows of the particle
+    buffer. The particles and weights are replaced everywhere they are shared. Their values
+    are left for the caller to fill in. The caller should hold state_lock
+      n_particles: The new number of particles
+  '''
+  def resize_particles(self, n_particles):
+    self.N_PARTICLES = n_particles
+    self.particle_indices = np.arange(n_particles)
+    self.particles = self.particle_buffer[:n_particles]
+    self.weights = self.weight_buffer[:n_particles]
+    self.resampler.set_particles(self.particles, self.weights)
+    self.motion_model.particles = self.particles
+    self.sensor_model.particles = self.particles
+    self.sensor_model.weights = self.weights
+
   '''
     Initialize the particles as uniform samples across the in-bounds regions of
     the map
@@ -203,17 +279,19 @@ class ParticleFilter():
     self.pub_tf.sendTransform(map_laser_pos, map_laser_rotation, stamp , "/base_link", "/map")
   '''
     Returns a 3 element numpy array representing the expected pose given the
-    current particles and weights
-    Uses weighted cosine and sine averaging to more accurately compute average theta
-      https://en.wikipedia.org/wiki/Mean_of_circular_quantities
+    current particles and weights, or of the heaviest cluster of particles if
+    self.POSE_CLUSTER_SIZE is set. See PoseEstimate.py
+      particles: The particles, defaults to self.particles
+      weights: The weights of the particles, defaults to self.weights
   '''
-  def expected_pose(self):
+  def expected_pose(self, particles=None, weights=None):
     # YOUR CODE HERE
-    assert np.allclose(np.sum(self.weights), 1), "self.weights does not sum to 1"
-    x = np.sum([self.weights[i] * self.particles[i][0] for i in range(len(self.particles))])
-    y = np.sum([self.weights[i] * self.particles[i][1] for i in range(len(self.particles))])
-    theta = np.arctan2(np.sum([np.sin(self.particles[i][2]) for i in range(len(self.particles))]), np.sum([np.cos(self.particles[i][2]) for i in range(len(self.particles))]))
-    return np.array([x, y, theta])
+    if particles is None:
+      particles, weights = self.particles, self.weights
+    assert np.allclose(np.sum(weights), 1), "weights does not sum to 1"
+    if self.POSE_CLUSTER_SIZE > 0.0:
+      return clustered_pose(particles, weights, self.POSE_CLUSTER_SIZE)
+    return weighted_mean_pose(particles, weights)
 
   '''
     Callback for '/initialpose' topic. RVIZ publishes a message to this topic when you specify an initial pose
@@ -237,27 +315,30 @@ class ParticleFilter():
     map_pose = np.array((rcvd_pose_x, rcvd_pose_y, rcvd_pose_theta), ndmin = 2 )
     Utils.world_to_map(map_pose, self.map_info)
 
-    for i in range(len(self.particles)):
-      # rospy.loginfo("This is the beginning of the for loop")
-      in_bounds = 0
-      x_samp = 0
-      y_samp = 0
-      while not in_bounds:
-        # rospy.loginfo("This is if the position is not in bounds") 
-        x_samp = int (np.random.normal(map_pose[:,0], .005) )# good std deviation?
-        y_samp = int (np.random.normal(map_pose[:,1], .005) ) # good std deviation?
-        in_bounds = self.permissible_region[y_samp][x_samp]
-        # rospy.loginfo(x_samp) 
-        # rospy.loginfo(y_samp)
-        # rospy.loginfo(in_bounds)
-
-      self.particles[i] = [x_samp,y_samp,map_pose[:,2]]
-      # rospy.loginfo("self.particles.shape")
-      # rospy.loginfo(self.particles.shape)
-      # rospy.loginfo("This is the end of the for loop")
+    # Draw every particle at once, then redraw only the ones that landed outside of the
+    # permissible region until all of them are inside
+    n_particles = len(self.particles)
+    rejected = np.arange(n_particles)
+    for i in xrange(CLICKED_POSE_MAX_ROUNDS):
+      self.particles[rejected,0] = np.random.normal(map_pose[0,0], CLICKED_POSE_XY_STD, rejected.shape[0])
+      self.particles[rejected,1] = np.random.normal(map_pose[0,1], CLICKED_POSE_XY_STD, rejected.shape[0])
+      px = np.floor(self.particles[rejected,0]).astype(np.int64)
+      py = np.floor(self.particles[rejected,1]).astype(np.int64)
+      in_bounds = (px >= 0) & (px < self.permissible_region.shape[1]) & (py >= 0) & (py < self.permissible_region.shape[0])
+      in_bounds[in_bounds] = self.permissible_region[py[in_bounds], px[in_bounds]]
+      rejected = rejected[~in_bounds]
+      if rejected.shape[0] == 0:
+        break
+    if rejected.shape[0] > 0: # The clicked pose itself is probably not permissible
+      rospy.logwarn('Placing %d particles at the clicked pose, which is not in the permissible region'%rejected.shape[0])
+      self.particles[rejected,:2] = map_pose[0,:2]
+    self.particles[:,2] = np.random.normal(map_pose[0,2], CLICKED_POSE_THETA_STD, n_particles)
 
     Utils.map_to_world(self.particles,self.map_info)
     self.weights[:] = [1 / float(len(self.particles))]
+    self.sensor_model.discard_pending_update() # Weight the new particles with the next scan even if the car is still
+    self.motion_model.clear_segments() # Motion that happened before the pose was clicked does not apply to the new particles
+    self.resampler.forget_copies() # The new particles are not copies of each other
     self.state_lock.release()
 
   '''
@@ -267,11 +348,77 @@ class ParticleFilter():
    (3) Publishes a PoseStamped message indicating the expected pose of the car
    (4) Publishes a subsample of the particles (use self.N_VIZ_PARTICLES).
        Sample so that particles with higher weights are more likely to be sampled.
+    (1) and (3) are published right away, because controllers follow the pose. If the
+    visualization thread is running, (2) and (4) are left to it and this only wakes it up
   '''
   def visualize(self):
     #print 'Visualizing...'
+    particles, weights, laser = self.snapshot_state(self.pose_particles, self.pose_weights)
+    self.publish_pose(particles, weights)
+    if self.viz_thread is not None:
+      with self.viz_cond:
+        self.viz_pending = True
+        self.viz_cond.notify()
+      return
+    self.publish_visualization(particles, weights, laser)
+
+  '''
+    Publishes the particles and the laser scan until shutdown, whenever visualize was called
+    but at most self.VIZ_RATE times per second
+  '''
+  def viz_loop(self):
+    rate = rospy.Rate(self.VIZ_RATE)
+    try:
+      while True:
+        with self.viz_cond:
+          while not (self.viz_pending or self.viz_shutdown):
+            self.viz_cond.wait() # A timed wait polls in python 2 and wakes up late
+          if self.viz_shutdown:
+            return
+          self.viz_pending = False
+        try:
+          self.publish_visualization(*self.snapshot_state(self.viz_particles, self.viz_weights))
+        except rospy.ROSInterruptException:
+          raise
+        except Exception as e: # Keep the thread alive, a lost frame is better than no visualization
+          rospy.logerr('Failed to publish the visualization: %s'%e)
+        rate.sleep()
+    except rospy.ROSInterruptException:
+      pass
+
+  '''
+    Wakes up the visualization thread on ROS shutdown so that it exits
+  '''
+  def viz_shutdown_cb(self):
+    with self.viz_cond:
+      self.viz_shutdown = True
+      self.viz_cond.notify()
+
+  '''
+    Copies the particles and weights into preallocated buffers, so that the pose and the
+    visualization can be computed without holding state_lock
+      particle_buffer: The buffer to copy the particles into
+      weight_buffer: The buffer to copy the weights into
+      Returns: The copies of the particles and the weights, and the most recent laser scan
+  '''
+  def snapshot_state(self, particle_buffer, weight_buffer):
     self.state_lock.acquire()
-    self.inferred_pose = self.expected_pose()
+    n_particles = self.particles.shape[0]
+    particles = particle_buffer[:n_particles]
+    weights = weight_buffer[:n_particles]
+    np.copyto(particles, self.particles)
+    np.copyto(weights, self.weights)
+    laser = self.sensor_model.last_laser
+    self.state_lock.release()
+    return particles, weights, laser
+
+  '''
+    Publishes the tf, the expected pose and the odometry of a snapshot of the filter, see visualize
+      particles: The particles
+      weights: The weights of the particles
+  '''
+  def publish_pose(self, particles, weights):
+    self.inferred_pose = self.expected_pose(particles, weights)
 
     if isinstance(self.inferred_pose, np.ndarray):
       if PUBLISH_TF:
@@ -289,20 +436,28 @@ class ParticleFilter():
         odom.pose.pose = ps.pose
         self.pub_odom.publish(odom)
 
+  '''
+    Publishes the particles and the laser scan of a snapshot of the filter, see visualize
+      particles: The particles
+      weights: The weights of the particles
+      laser: The most recent laser scan, None if there is none yet
+  '''
+  def publish_visualization(self, particles, weights, laser):
     if self.particle_pub.get_num_connections() > 0:
-      if self.particles.shape[0] > self.N_VIZ_PARTICLES:
+      if particles.shape[0] > self.N_VIZ_PARTICLES:
         # randomly downsample particles
-        proposal_indices = np.random.choice(self.particle_indices, size=self.N_VIZ_PARTICLES, replace=False, p=self.weights)
+        # Weights carried across updates can have fewer nonzero entries than N_VIZ_PARTICLES
+        replace = np.count_nonzero(weights) < self.N_VIZ_PARTICLES
+        proposal_indices = np.random.choice(particles.shape[0], size=self.N_VIZ_PARTICLES, replace=replace, p=weights)
         # proposal_indices = np.random.choice(self.particle_indices, self.N_VIZ_PARTICLES)
-        self.publish_particles(self.particles[proposal_indices,:])
+        self.publish_particles(particles[proposal_indices,:])
       else:
-        self.publish_particles(self.particles)
+        self.publish_particles(particles)
 
-    if self.pub_laser.get_num_connections() > 0 and isinstance(self.sensor_model.last_laser, LaserScan):
-      self.sensor_model.last_laser.header.frame_id = "/laser"
-      self.sensor_model.last_laser.header.stamp = rospy.Time.now()
-      self.pub_laser.publish(self.sensor_model.last_laser)
-    self.state_lock.release()
+    if self.pub_laser.get_num_connections() > 0 and isinstance(laser, LaserScan):
+      laser.header.frame_id = "/laser"
+      laser.header.stamp = rospy.Time.now()
+      self.pub_laser.publish(laser)
 
   '''
   Helper function for publishing a pose array of particles
@@ -314,6 +469,36 @@ class ParticleFilter():
     pa.poses = Utils.particles_to_poses(particles)
     self.particle_pub.publish(pa)
 
+'''
+  Resamples and publishes whenever the sensor model says so, until shutdown
+    pf: The ParticleFilter
+'''
+def resample_loop(pf):
+  while not rospy.is_shutdown(): # Keep going until we kill it
+    # Callbacks are running in separate threads. Sleep until the sensor model says it's time to
+    # resample or publish, instead of spinning on its flags
+    do_resample, do_publish = pf.sensor_model.wait_for_update()
+    if do_resample:
+
+      # Resample
+      if pf.RESAMPLE_TYPE == "naiive":
+        pf.resampler.resample_naiive()
+      elif pf.RESAMPLE_TYPE == "low_variance":
+        pf.resampler.resample_low_variance()
+      elif pf.RESAMPLE_TYPE == "stratified":
+        pf.resampler.resample_stratified()
+      elif pf.RESAMPLE_TYPE == "residual":
+        pf.resampler.resample_residual()
+      elif pf.RESAMPLE_TYPE == "kld":
+        pf.resampler.resample_kld()
+      else:
+        print "Unrecognized resampling method: "+ pf.RESAMPLE_TYPE
+
+      pf.visualize() # Perform visualization
+
+    elif do_publish: # The sensor model skipped a scan, but the pose should still be published
+      pf.visualize()
+
 # Suggested main
 if __name__ == '__main__':
   rospy.init_node("particle_filter", anonymous=True) # Initialize the node
@@ -326,7 +511,26 @@ if __name__ == '__main__':
   laser_ray_step = int(rospy.get_param("~laser_ray_step")) # Step for downsampling laser scans
   exclude_max_range_rays = bool(rospy.get_param("~exclude_max_range_rays")) # Whether to exclude rays that are beyond the max range
   max_range_meters = float(rospy.get_param("~max_range_meters")) # The max range of the laser
-  resample_type = rospy.get_param("~resample_type", "naiive") # Whether to use naiive or low variance sampling
+  resample_type = rospy.get_param("~resample_type", "naiive") # Whether to use naiive, low variance, stratified, residual or KLD sampling
+  range_method_type = rospy.get_param("~range_method", "cddt") # The ray casting backend, cddt, rmgpu, numpy or lut
+  sensor_model_type = rospy.get_param("~sensor_model_type", "beam") # Whether to use the beam or likelihood field sensor model
+  range_cache_size = int(rospy.get_param("~range_cache_size", 0)) # Number of range vectors to memoize, 0 disables the cache
+  cascade_fraction = float(rospy.get_param("~cascade_fraction", 0.0)) # Fraction of particles rescored with every ray, 0 disables the cascade
+  beam_budget = int(rospy.get_param("~beam_budget", 0)) # Number of informative rays to select per scan, 0 uses laser_ray_step
+  update_min_d = float(rospy.get_param("~update_min_d", 0.0)) # Translation in meters required before a sensor update
+  update_min_a = float(rospy.get_param("~update_min_a", 0.0)) # Rotation in radians required before a sensor update
+  log_likelihood = bool(rospy.get_param("~log_likelihood", False)) # Whether the sensor model sums log-probabilities
+  n_workers = int(rospy.get_param("~n_workers", 1)) # Number of threads that the sensor update is sharded across
+  noise_seed = int(rospy.get_param("~noise_seed", -1)) # Seed of the motion model noise, negative to seed from the OS
+  if noise_seed < 0:
+    noise_seed = None
+  coalesce_motion = bool(rospy.get_param("~coalesce_motion", False)) # Whether to merge vesc state msgs between sensor updates
+  motion_flush_rate = float(rospy.get_param("~motion_flush_rate", 0.0)) # Rate in Hz at which coalesced motion is applied between sensor updates
+  resample_ess_fraction = float(rospy.get_param("~resample_ess_fraction", 1.0)) # Fraction of the particles that the effective sample size must fall below to resample
+  kld_min_particles = int(rospy.get_param("~kld_min_particles", 100)) # The fewest particles that KLD sampling keeps
+  kld_max_particles = int(rospy.get_param("~kld_max_particles", 5000)) # The most particles that KLD sampling keeps
+  pose_cluster_size = float(rospy.get_param("~pose_cluster_size", 0.0)) # Size of the cells that particles are clustered in for the expected pose, 0 disables clustering
+  viz_rate = float(rospy.get_param("~viz_rate", 0.0)) # Max rate in Hz at which a separate thread publishes the particles and the laser scan, 0 disables the thread
 
   speed_to_erpm_offset = float(rospy.get_param("/vesc/speed_to_erpm_offset", 0.0)) # Offset conversion param from rpm to speed
   speed_to_erpm_gain = float(rospy.get_param("/vesc/speed_to_erpm_gain", 4350))   # Gain conversion param from rpm to speed
@@ -339,19 +543,16 @@ if __name__ == '__main__':
                       motor_state_topic, servo_state_topic, scan_topic, laser_ray_step,
                       exclude_max_range_rays, max_range_meters, resample_type,
                       speed_to_erpm_offset, speed_to_erpm_gain, steering_angle_to_servo_offset,
-                      steering_angle_to_servo_gain, car_length)
-
-  while not rospy.is_shutdown(): # Keep going until we kill it
-    # Callbacks are running in separate threads
-    if pf.sensor_model.do_resample: # Check if the sensor model says it's time to resample
-      pf.sensor_model.do_resample = False # Reset so that we don't keep resampling
-
-      # Resample
-      if pf.RESAMPLE_TYPE == "naiive":
-        pf.resampler.resample_naiive()
-      elif pf.RESAMPLE_TYPE == "low_variance":
-        pf.resampler.resample_low_variance()
-      else:
-        print "Unrecognized resampling method: "+ pf.RESAMPLE_TYPE
-
-      pf.visualize() # Perform visualization
+                      steering_angle_to_servo_gain, car_length, range_method_type, sensor_model_type,
+                      range_cache_size, cascade_fraction, beam_budget,
+                      update_min_d, update_min_a, log_likelihood, n_workers,
+                      noise_seed, coalesce_motion, motion_flush_rate,
+                      resample_ess_fraction, kld_min_particles, kld_max_particles,
+                      pose_cluster_size, viz_rate)
+
+  # The main thread sits in rospy.spin, because in python 2 only the main thread handles signals
+  # and it would not do so while blocked in wait_for_update
+  resample_thread = Thread(target=resample_loop, args=(pf,))
+  resample_thread.daemon = True
+  resample_thread.start()
+  rospy.spin()
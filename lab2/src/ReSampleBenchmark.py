@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import argparse
+import json
+import platform
+
+import numpy as np
+
+from timeit import default_timer as timer
+from ReSample import ReSampler
+
+RESAMPLE_TYPES = ['naiive', 'low_variance', 'stratified', 'residual'] # The resamplers that are compared
+DEFAULT_PARTICLES = [100, 1000, 10000, 100000, 1000000]
+DEFAULT_WEIGHTINGS = ['uniform', 'ramp', 'peaked']
+DEFAULT_STATS_MAX_PARTICLES = 10000 # Copy count statistics need many trials, so they are only gathered for smaller N
+PEAKED_SIGMA = 0.01 # Width of the peaked weighting, as a fraction of the particles
+
+'''
+  Makes the weights that the particles are resampled with
+    weighting: 'uniform', 'ramp' (like the ReSample.py test, increasing up to 80% of the particles
+               and zero beyond) or 'peaked' (a narrow gaussian, as after a sharp sensor update)
+    n_particles: The number of particles
+    Returns: Numpy array of dimension (n_particles,) of normalized weights
+'''
+def make_weights(weighting, n_particles):
+  if weighting == 'uniform':
+    weights = np.ones(n_particles)
+  elif weighting == 'ramp':
+    weights = np.arange(n_particles, dtype=np.float64)
+    weights[int(0.8 * n_particles):] = 0.0
+  elif weighting == 'peaked':
+    x = (np.arange(n_particles) - 0.5 * n_particles) / (PEAKED_SIGMA * n_particles)
+    weights = np.exp(-0.5 * np.square(x)) + 1e-12
+  else:
+    raise ValueError('Unrecognized weighting: ' + weighting)
+  return weights / np.sum(weights)
+
+'''
+  Computes the variance of the number of times that each particle is copied, which is
+  known in closed form for every resampler
+    resample_type: One of RESAMPLE_TYPES
+    weights: The normalized weights
+    Returns: Numpy array of dimension (N,) of the variance of the copy count of each particle
+'''
+def theoretical_variance(resample_type, weights):
+  n_particles = weights.shape[0]
+  expected = n_particles * weights
+
+  if resample_type == 'naiive':
+    # Multinomial counts
+    return expected * (1 - weights)
+
+  if resample_type == 'low_variance':
+    # A single offset, so a particle is copied floor(N*w) or ceil(N*w) times
+    frac = expected - np.floor(expected)
+    return frac * (1 - frac)
+
+  if resample_type == 'stratified':
+    # Each stratum that the particle covers a fraction f of contributes an independent
+    # Bernoulli(f), and only the strata at the two ends of its interval are covered partially
+    upper = n_particles * np.cumsum(weights)
+    lower = upper - expected
+    same = np.floor(lower) == np.floor(upper)
+    left = np.ceil(lower) - lower
+    right = upper - np.floor(upper)
+    var = left * (1 - left) + right * (1 - right)
+    var[same] = expected[same] * (1 - expected[same])
+    return var
+
+  if resample_type == 'residual':
+    # Multinomial counts of the residual weights over the slots left after the deterministic copies
+    residual = expected - np.floor(expected)
+    n_residual = n_particles - np.sum(np.floor(expected))
+    if n_residual <= 0:
+      return np.zeros(n_particles)
+    p = residual / np.sum(residual)
+    return n_residual * p * (1 - p)
+
+  raise ValueError('Unrecognized resampling method: ' + resample_type)
+
+'''
+  Creates a resampler over particles that encode their own index, as in the ReSample.py test
+    weights: The normalized weights
+    Returns: The ReSampler, its particles and its weights
+'''
+def make_resampler(weights):
+  particles = np.repeat(np.arange(weights.shape[0])[:,np.newaxis], 3, axis=1)
+  weights = weights.copy()
+  return ReSampler(particles, weights), particles, weights
+
+'''
+  Times a resampler
+    resample_type: One of RESAMPLE_TYPES
+    weights: The normalized weights
+    trials: Number of times to resample
+    Returns: The median time in ms of a resample
+'''
+def time_resampler(resample_type, weights, trials):
+  rs, particles, rs_weights = make_resampler(weights)
+  resample = getattr(rs, 'resample_' + resample_type)
+  times = []
+  for i in xrange(trials):
+    particles[:,0] = rs.particle_idxs
+    rs_weights[:] = weights # Resampling makes the weights uniform
+    start = timer()
+    resample()
+    times.append(timer() - start)
+  return 1000.0 * float(np.median(times))
+
+'''
+  Measures the variance of the copy count of each particle over many resamples
+    resample_type: One of RESAMPLE_TYPES
+    weights: The normalized weights
+    trials: Number of times to resample
+    Returns: Numpy array of dimension (N,) of the sample variance of each copy count
+'''
+def copy_count_variance(resample_type, weights, trials):
+  rs, particles, rs_weights = make_resampler(weights)
+  resample = getattr(rs, 'resample_' + resample_type)
+  n_particles = weights.shape[0]
+  total = np.zeros(n_particles)
+  total_sq = np.zeros(n_particles)
+  for i in xrange(trials):
+    particles[:,0] = rs.particle_idxs
+    rs_weights[:] = weights
+    resample()
+    counts = np.bincount(particles[:,0].astype(np.int64), minlength=n_particles)
+    total += counts
+    total_sq += np.square(counts)
+  mean = total / trials
+  return (total_sq - trials * np.square(mean)) / (trials - 1)
+
+'''
+  Times every resampler for a sweep of particle counts and weightings, compares the variance
+  of the copy counts against theory, and writes the results as JSON
+'''
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description='ReSampler benchmark')
+  parser.add_argument('--output', default='resample_benchmark.json', help='Where to write the results')
+  parser.add_argument('--particles', type=int, nargs='+', default=DEFAULT_PARTICLES)
+  parser.add_argument('--weightings', nargs='+', default=DEFAULT_WEIGHTINGS)
+  parser.add_argument('--resample_types', nargs='+', default=RESAMPLE_TYPES)
+  parser.add_argument('--timing_trials', type=int, default=20, help='Number of times that each resampler is timed')
+  parser.add_argument('--stats_trials', type=int, default=500, help='Number of resamples that copy count statistics are gathered over')
+  parser.add_argument('--stats_max_particles', type=int, default=DEFAULT_STATS_MAX_PARTICLES)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  np.random.seed(args.seed)
+  results = []
+  for weighting in args.weightings:
+    for n_particles in args.particles:
+      weights = make_weights(weighting, n_particles)
+      for resample_type in args.resample_types:
+        result = {'resample_type': resample_type, 'weighting': weighting, 'n_particles': n_particles}
+        result['time_ms'] = time_resampler(resample_type, weights, args.timing_trials)
+        result['theoretical_variance'] = float(np.mean(theoretical_variance(resample_type, weights)))
+        result['measured_variance'] = None
+        if n_particles <= args.stats_max_particles:
+          result['measured_variance'] = float(np.mean(copy_count_variance(resample_type, weights, args.stats_trials)))
+        results.append(result)
+        print('%s weights, %d particles, %s: %.3f ms, mean copy count variance %s (theory %.4f)'%(
+              weighting, n_particles, resample_type, result['time_ms'],
+              'n/a' if result['measured_variance'] is None else '%.4f'%result['measured_variance'],
+              result['theoretical_variance']))
+
+  with open(args.output, 'w') as f:
+    json.dump({'timing_trials': args.timing_trials,
+               'stats_trials': args.stats_trials,
+               'seed': args.seed,
+               'numpy': np.__version__,
+               'python': platform.python_version(),
+               'results': results}, f, indent=2, sort_keys=True)
+  print 'Wrote ' + args.output
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import argparse
+import glob
+import json
+import os
+import platform
+
+import numpy as np
+
+from timeit import default_timer as timer
+import rosbag
+import utils as Utils
+import yaml
+from nav_msgs.msg import OccupancyGrid
+from SensorModel import SensorModel
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MAP = os.path.join(SRC_DIR, '..', '..', 'lab3', 'maps', 'real-floor4_corridor.yaml') # Map that the laser_scans bags were recorded in
+DEFAULT_BAGS = os.path.join(SRC_DIR, '..', 'bags', 'laser_scans', '*.bag')
+DEFAULT_PARTICLES = [1000, 4000, 16000]
+DEFAULT_RAY_STEPS = [9, 18, 36]
+DEFAULT_BEAM_BUDGETS = [30, 60]
+REFERENCE_RAY_STEP = 1 # Every configuration is compared against the weights computed with every ray,
+                       # which are always log-likelihoods since a product over every ray underflows
+
+'''
+  Reads a binary (P5) PGM image, as written by map_saver
+    path: The path of the image
+    Returns: Numpy array of dimension (height, width) of pixel values, and the max pixel value
+'''
+def read_pgm(path):
+  with open(path, 'rb') as f:
+    data = f.read()
+
+  # The header is four whitespace separated fields, possibly interleaved with comments
+  fields = []
+  pos = 0
+  while len(fields) < 4:
+    if data[pos:pos+1].isspace():
+      pos += 1
+    elif data[pos:pos+1] == b'#':
+      pos = data.index(b'\n', pos)
+    else:
+      end = pos
+      while not data[end:end+1].isspace():
+        end += 1
+      fields.append(data[pos:end])
+      pos = end
+  if fields[0] != b'P5':
+    raise ValueError('Only binary PGM images are supported: ' + path)
+  width, height, max_val = int(fields[1]), int(fields[2]), int(fields[3])
+
+  dtype = np.uint8 if max_val < 256 else np.dtype('>u2')
+  pixels = np.frombuffer(data, dtype=dtype, count=width*height, offset=pos+1)
+  return pixels.reshape((height, width)), max_val
+
+'''
+  Loads a map the same way that map_server does, without needing a running map server
+    yaml_path: The path of a map_server YAML file
+    Returns: A nav_msgs/OccupancyGrid msg containing the map
+'''
+def load_map(yaml_path):
+  with open(yaml_path) as f:
+    meta = yaml.safe_load(f)
+  image_path = os.path.join(os.path.dirname(yaml_path), meta['image'])
+  if not os.path.exists(image_path):
+    raise IOError('Map image %s does not exist, copy it next to %s'%(image_path, yaml_path))
+  pixels, max_val = read_pgm(image_path)
+
+  # Darker pixels are more likely to be occupied, unless the map is negated
+  occupancy = pixels.astype(np.float64) / max_val
+  if not meta.get('negate', 0):
+    occupancy = 1.0 - occupancy
+  grid = np.full(pixels.shape, -1, dtype=np.int8)
+  grid[occupancy > meta['occupied_thresh']] = 100
+  grid[occupancy < meta['free_thresh']] = 0
+
+  map_msg = OccupancyGrid()
+  map_msg.info.resolution = meta['resolution']
+  map_msg.info.width = pixels.shape[1]
+  map_msg.info.height = pixels.shape[0]
+  map_msg.info.origin.position.x = meta['origin'][0]
+  map_msg.info.origin.position.y = meta['origin'][1]
+  map_msg.info.origin.orientation = Utils.angle_to_quaternion(meta['origin'][2])
+  map_msg.data = np.flipud(grid).ravel().tolist() # The first image row is the top of the map, the first grid row is the bottom
+  return map_msg
+
+'''
+  Reads every laser scan from a list of bags
+    bag_paths: The paths of the bags
+    Returns: A list of (bag name, sensor_msgs/LaserScan) tuples
+'''
+def load_scans(bag_paths):
+  scans = []
+  for bag_path in bag_paths:
+    bag = rosbag.Bag(bag_path)
+    for _, msg, _ in bag.read_messages():
+      if msg._type == 'sensor_msgs/LaserScan':
+        scans.append((os.path.basename(bag_path), msg))
+    bag.close()
+  return scans
+
+'''
+  Samples particles uniformly over the free space of the map
+    map_msg: A nav_msgs/OccupancyGrid msg containing the map
+    n_particles: The number of particles
+    rng: The numpy RandomState to sample with
+    Returns: Numpy array of dimension (n_particles,3) of poses in the world
+'''
+def sample_particles(map_msg, n_particles, rng):
+  array_255 = np.array(map_msg.data).reshape((map_msg.info.height, map_msg.info.width))
+  permissible_y, permissible_x = np.where(array_255 == 0)
+  idxs = rng.randint(0, permissible_x.shape[0], n_particles)
+  particles = np.zeros((n_particles, 3))
+  particles[:,0] = permissible_x[idxs] + rng.uniform(0, 1, n_particles)
+  particles[:,1] = permissible_y[idxs] + rng.uniform(0, 1, n_particles)
+  particles[:,2] = rng.uniform(-np.pi, np.pi, n_particles)
+  Utils.map_to_world(particles, map_msg.info)
+  return particles
+
+'''
+  Normalizes the weights computed by a sensor model
+    weights: The weights, which are log-likelihoods if log_likelihood is set
+    log_likelihood: Whether the weights are log-likelihoods
+    Returns: The normalized weights, or None if every weight underflowed
+'''
+def normalize(weights, log_likelihood):
+  if log_likelihood:
+    weights = np.exp(weights - np.max(weights))
+  total = np.sum(weights)
+  if not total > 0 or not np.isfinite(total):
+    return None
+  return weights / total
+
+'''
+  Times the stages of the sensor model for every scan
+    sm: The SensorModel
+    particles: The particles to weight
+    scans: A list of (bag name, sensor_msgs/LaserScan) tuples
+    trials: Number of times that each scan is timed
+    Returns: A dict of the median time in ms of each stage, the mean number of rays, and the
+             normalized weights of the particles after each scan
+'''
+def time_sensor_model(sm, particles, scans, trials):
+  n_particles = particles.shape[0]
+  queries = np.array(particles, dtype=np.float32)
+  weights = np.zeros(n_particles)
+  times = {'preprocess_ms': [], 'cast_ms': [], 'eval_ms': [], 'update_ms': []}
+  n_rays = []
+  scan_weights = []
+
+  for _, msg in scans:
+    for i in xrange(trials):
+      start = timer()
+      obs = sm.preprocess_scan(msg)
+      times['preprocess_ms'].append(timer() - start)
+      n_rays.append(obs[1].shape[0] if obs[2] is None else np.count_nonzero(obs[2]))
+
+      # Time ray casting and evaluation on their own, casting every particle with every ray and
+      # skipping the cascade's coarse pass. The particles are not resampled copies, so the update
+      # below casts every one of them too
+      if sm.range_method is not None:
+        ranges = np.zeros(n_particles * obs[1].shape[0], dtype=np.float32)
+        start = timer()
+        sm.range_method.calc_range_repeat_angles(queries, obs[1], ranges)
+        times['cast_ms'].append(timer() - start)
+        start = timer()
+        sm.eval_sensor_model(obs[0], ranges, weights, obs[1].shape[0], n_particles, obs[2])
+        times['eval_ms'].append(timer() - start)
+
+      start = timer()
+      sm.apply_sensor_model(particles, obs, weights)
+      times['update_ms'].append(timer() - start)
+    scan_weights.append(normalize(weights, sm.LOG_LIKELIHOOD))
+
+  result = {}
+  for stage, stage_times in times.items():
+    result[stage] = 1000.0 * float(np.median(stage_times)) if len(stage_times) > 0 else None
+  result['n_rays'] = float(np.mean(n_rays))
+  return result, scan_weights
+
+'''
+  Measures how far the weights of a configuration are from the reference weights
+    scan_weights: The normalized weights after each scan
+    reference_weights: The normalized reference weights after each scan
+    Returns: The mean total variation distance over the scans, None if any weights underflowed
+'''
+def weight_error(scan_weights, reference_weights):
+  distances = []
+  for weights, reference in zip(scan_weights, reference_weights):
+    if weights is None or reference is None:
+      return None
+    distances.append(0.5 * np.sum(np.abs(weights - reference)))
+  return float(np.mean(distances))
+
+'''
+  Replays the laser scans of bags through SensorModel without a roscore or map server,
+  timing preprocessing, ray casting and sensor model evaluation separately for a sweep of
+  particle counts, laser_ray_step and beam_budget, and writes the results as JSON
+'''
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description='Offline SensorModel benchmark')
+  parser.add_argument('--map', default=DEFAULT_MAP, help='map_server YAML file of the map')
+  parser.add_argument('--bags', default=DEFAULT_BAGS, help='Glob of the bags to read laser scans from')
+  parser.add_argument('--output', default='sensor_model_benchmark.json', help='Where to write the results')
+  parser.add_argument('--particles', type=int, nargs='+', default=DEFAULT_PARTICLES)
+  parser.add_argument('--laser_ray_steps', type=int, nargs='+', default=DEFAULT_RAY_STEPS)
+  parser.add_argument('--beam_budgets', type=int, nargs='+', default=DEFAULT_BEAM_BUDGETS)
+  parser.add_argument('--range_method', default='cddt')
+  parser.add_argument('--sensor_model_type', default='beam')
+  parser.add_argument('--max_range_meters', type=float, default=11.0)
+  parser.add_argument('--include_max_range_rays', action='store_true')
+  parser.add_argument('--log_likelihood', action='store_true')
+  parser.add_argument('--trials', type=int, default=5, help='Number of times that each scan is timed')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  print 'Loading map ' + args.map
+  map_msg = load_map(args.map)
+  bag_paths = sorted(glob.glob(args.bags))
+  scans = load_scans(bag_paths)
+  print 'Loaded %d scans from %d bags'%(len(scans), len(bag_paths))
+
+  # (laser_ray_step, beam_budget) of every configuration, the reference comes first
+  configs = [(REFERENCE_RAY_STEP, 0)]
+  configs += [(step, 0) for step in args.laser_ray_steps if step != REFERENCE_RAY_STEP]
+  configs += [(REFERENCE_RAY_STEP, budget) for budget in args.beam_budgets if budget > 0]
+
+  results = []
+  rng = np.random.RandomState(args.seed)
+  for n_particles in args.particles:
+    particles = sample_particles(map_msg, n_particles, rng)
+    reference_weights = None
+    for laser_ray_step, beam_budget in configs:
+      log_likelihood = args.log_likelihood or reference_weights is None
+      sm = SensorModel(None, laser_ray_step, not args.include_max_range_rays, args.max_range_meters,
+                       map_msg, particles.copy(), np.zeros(n_particles),
+                       range_method_type=args.range_method, sensor_model_type=args.sensor_model_type,
+                       beam_budget=beam_budget, log_likelihood=log_likelihood)
+      result, scan_weights = time_sensor_model(sm, particles, scans, args.trials)
+      if reference_weights is None:
+        reference_weights = scan_weights
+      result['n_particles'] = n_particles
+      result['laser_ray_step'] = laser_ray_step
+      result['beam_budget'] = beam_budget
+      result['log_likelihood'] = log_likelihood
+      result['weight_error'] = weight_error(scan_weights, reference_weights)
+      results.append(result)
+      print('%d particles, laser_ray_step %d, beam_budget %d: %.0f rays, preprocess %.3f ms, update %.3f ms, error %s'%(
+            n_particles, laser_ray_step, beam_budget, result['n_rays'], result['preprocess_ms'],
+            result['update_ms'], result['weight_error']))
+
+  with open(args.output, 'w') as f:
+    json.dump({'map': os.path.basename(args.map),
+               'bags': [os.path.basename(p) for p in bag_paths],
+               'range_method': args.range_method,
+               'sensor_model_type': args.sensor_model_type,
+               'max_range_meters': args.max_range_meters,
+               'exclude_max_range_rays': not args.include_max_range_rays,
+               'trials': args.trials,
+               'seed': args.seed,
+               'numpy': np.__version__,
+               'python': platform.python_version(),
+               'results': results}, f, indent=2, sort_keys=True)
+  print 'Wrote ' + args.output
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import utils as Utils
+from nav_msgs.msg import OccupancyGrid
+from RangeMethods import CachedRangeMethod, LookupTableCast, NumpyRayMarching
+
+MAP_SIZE = 200 # Width and height of the test map in pixels
+MAP_RESOLUTION = 0.05
+MAX_RANGE_PX = 300
+N_QUERIES = 300
+N_ANGLES = 30
+TOLERANCE_PX = 0.01
+CACHE_THETA_BINS = 112
+CACHE_ENTRIES = 200 # Small enough that the cache evicts entries in every call
+LUT_THETA_BINS = 16
+
+'''
+  Makes a map with a border, two crossing one cell thick diagonal walls and a thick wall
+  Returns: A nav_msgs/OccupancyGrid msg of the map, and the grid as a numpy array
+'''
+def make_map():
+  grid = np.zeros((MAP_SIZE, MAP_SIZE), dtype=np.int8)
+  grid[0,:] = grid[-1,:] = grid[:,0] = grid[:,-1] = 100
+  for i in xrange(30, 170):
+    grid[i,i] = 100
+    grid[i,MAP_SIZE-i] = 100
+  grid[120:125,20:60] = 100
+
+  map_msg = OccupancyGrid()
+  map_msg.info.resolution = MAP_RESOLUTION
+  map_msg.info.width = MAP_SIZE
+  map_msg.info.height = MAP_SIZE
+  map_msg.info.origin.position.x = 0.0
+  map_msg.info.origin.position.y = 0.0
+  map_msg.info.origin.orientation = Utils.angle_to_quaternion(0.0)
+  map_msg.data = grid.ravel().tolist()
+  return map_msg, grid
+
+'''
+  Casts a ray exactly by visiting every cell between consecutive cell boundary crossings
+    grid: The map grid, nonzero cells are obstacles
+    x0, y0: The start of the ray in pixels
+    theta: The angle of the ray
+    Returns: The range in pixels of the first obstacle, or MAX_RANGE_PX
+'''
+def brute_force_cast(grid, x0, y0, theta):
+  c, s = np.cos(theta), np.sin(theta)
+  crossings = [0.0, MAX_RANGE_PX]
+  for p0, d in [(x0, c), (y0, s)]:
+    if abs(d) > 1e-12:
+      lines = np.arange(np.floor(min(p0, p0 + MAX_RANGE_PX * d)), np.ceil(max(p0, p0 + MAX_RANGE_PX * d)) + 1)
+      t = (lines - p0) / d
+      crossings.extend(t[(t > 0) & (t < MAX_RANGE_PX)])
+  crossings = np.sort(crossings)
+
+  # The ray is inside a single cell between consecutive crossings
+  mid = 0.5 * (crossings[:-1] + crossings[1:])
+  xs = np.floor(x0 + mid * c).astype(np.int64)
+  ys = np.floor(y0 + mid * s).astype(np.int64)
+  blocked = (xs < 0) | (xs >= grid.shape[1]) | (ys < 0) | (ys >= grid.shape[0])
+  blocked[~blocked] = grid[ys[~blocked], xs[~blocked]] != 0
+  if not np.any(blocked):
+    return MAX_RANGE_PX
+  return crossings[np.argmax(blocked)]
+
+class TestNumpyRayMarching(unittest.TestCase):
+
+  '''
+    Rays must neither stop early nor cut through the corners of one cell thick diagonal walls
+  '''
+  def test_matches_brute_force(self):
+    map_msg, grid = make_map()
+    range_method = NumpyRayMarching(map_msg, MAX_RANGE_PX)
+
+    rng = np.random.RandomState(0)
+    free = np.argwhere(grid == 0)
+    idxs = free[rng.randint(0, free.shape[0], N_QUERIES)]
+    queries = np.zeros((N_QUERIES, 3), dtype=np.float32)
+    queries[:,0] = idxs[:,1] + rng.uniform(0, 1, N_QUERIES)
+    queries[:,1] = idxs[:,0] + rng.uniform(0, 1, N_QUERIES)
+    queries[:,2] = rng.uniform(-np.pi, np.pi, N_QUERIES)
+    Utils.map_to_world(queries, map_msg.info)
+    angles = np.linspace(-np.pi, np.pi, N_ANGLES, endpoint=False).astype(np.float32)
+
+    ranges = np.zeros(N_QUERIES * N_ANGLES, dtype=np.float32)
+    range_method.calc_range_repeat_angles(queries, angles, ranges)
+
+    # Cast from the same float32 poses and angles that the range method saw
+    map_queries = np.array(queries, dtype=np.float32)
+    Utils.world_to_map(map_queries, map_msg.info)
+    for i in xrange(N_QUERIES):
+      for j in xrange(N_ANGLES):
+        theta = np.float32(map_queries[i,2] + angles[j])
+        expected = brute_force_cast(grid, float(map_queries[i,0]), float(map_queries[i,1]), float(theta))
+        self.assertAlmostEqual(ranges[i*N_ANGLES+j] / MAP_RESOLUTION, expected, delta=TOLERANCE_PX)
+
+class TestCachedRangeMethod(unittest.TestCase):
+
+  '''
+    Cached ranges must be the ranges cast from the center of each quantization cell, also
+    after entries were evicted and when two angle sets take turns
+  '''
+  def test_matches_cell_centers(self):
+    map_msg, grid = make_map()
+    range_method = NumpyRayMarching(map_msg, MAX_RANGE_PX)
+    cached = CachedRangeMethod(range_method, map_msg.info, CACHE_ENTRIES, CACHE_THETA_BINS)
+
+    rng = np.random.RandomState(0)
+    free = np.argwhere(grid == 0)
+    cells = free[rng.randint(0, free.shape[0], N_QUERIES)]
+    theta_bins = rng.randint(0, CACHE_THETA_BINS, N_QUERIES)
+    angle_sets = [np.linspace(-np.pi, np.pi, N_ANGLES, endpoint=False).astype(np.float32),
+                  np.linspace(-np.pi, np.pi, N_ANGLES // 3, endpoint=False).astype(np.float32)]
+    for i in xrange(6):
+      # Draw poses from a small set of cells so that some are cached and some are not
+      idxs = rng.randint(0, N_QUERIES // 2 + 50 * i, N_QUERIES) % N_QUERIES
+      queries = np.zeros((N_QUERIES, 3), dtype=np.float32)
+      queries[:,0] = cells[idxs,1] + rng.uniform(0.1, 0.9, N_QUERIES)
+      queries[:,1] = cells[idxs,0] + rng.uniform(0.1, 0.9, N_QUERIES)
+      queries[:,2] = (theta_bins[idxs] + rng.uniform(-0.4, 0.4, N_QUERIES)) * (2 * np.pi / CACHE_THETA_BINS)
+      centers = np.zeros((N_QUERIES, 3), dtype=np.float32)
+      centers[:,0] = cells[idxs,1] + 0.5
+      centers[:,1] = cells[idxs,0] + 0.5
+      centers[:,2] = theta_bins[idxs] * (2 * np.pi / CACHE_THETA_BINS)
+      Utils.map_to_world(queries, map_msg.info)
+      Utils.map_to_world(centers, map_msg.info)
+
+      angles = angle_sets[i % 2]
+      ranges = np.zeros(N_QUERIES * angles.shape[0], dtype=np.float32)
+      expected = np.zeros(N_QUERIES * angles.shape[0], dtype=np.float32)
+      cached.calc_range_repeat_angles(queries, angles, ranges)
+      range_method.calc_range_repeat_angles(centers, angles, expected)
+      np.testing.assert_allclose(ranges, expected, atol=1e-4)
+    self.assertGreater(cached.hits, 0)
+    self.assertEqual(cached.hits + cached.misses, 6 * N_QUERIES)
+
+class TestLookupTableCast(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  '''
+    A start that loads a stored table must cast the same ranges as the start that built it,
+    without computing the distance transform
+  '''
+  def test_warm_start_matches_build(self):
+    map_msg, grid = make_map()
+    built = LookupTableCast(map_msg, MAX_RANGE_PX, LUT_THETA_BINS, self.cache_dir)
+    loaded = LookupTableCast(map_msg, MAX_RANGE_PX, LUT_THETA_BINS, self.cache_dir)
+    self.assertTrue(hasattr(built, 'dist'))
+    self.assertFalse(hasattr(loaded, 'dist'))
+
+    # Includes poses outside of the map, which must read as zero range
+    rng = np.random.RandomState(0)
+    queries = np.zeros((N_QUERIES, 3), dtype=np.float32)
+    queries[:,0] = rng.uniform(-10, MAP_SIZE + 10, N_QUERIES)
+    queries[:,1] = rng.uniform(-10, MAP_SIZE + 10, N_QUERIES)
+    queries[:,2] = rng.uniform(-np.pi, np.pi, N_QUERIES)
+    Utils.map_to_world(queries, map_msg.info)
+    angles = np.linspace(-np.pi, np.pi, N_ANGLES, endpoint=False).astype(np.float32)
+    expected = np.zeros(N_QUERIES * N_ANGLES, dtype=np.float32)
+    ranges = np.zeros(N_QUERIES * N_ANGLES, dtype=np.float32)
+    built.calc_range_repeat_angles(queries, angles, expected)
+    loaded.calc_range_repeat_angles(queries, angles, ranges)
+    np.testing.assert_array_equal(ranges, expected)
+    self.assertGreater(np.sum(expected > 0), 0)
+    self.assertGreater(np.sum(expected == 0), 0)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ReSample import ReSampler
+
+N_PARTICLES = 100
+K_VAL = 80 # Number of particles that have non-zero weight
+RESAMPLE_TYPES = ['naiive', 'low_variance', 'stratified', 'residual', 'kld']
+
+'''
+  Makes particles that encode their own index and weights that increase up to K_VAL, like the
+  ReSample.py test
+  Returns: The integer particles and the normalized weights
+'''
+def make_particles():
+  particles = np.repeat(np.arange(N_PARTICLES)[:,np.newaxis], 3, axis=1)
+  weights = np.arange(N_PARTICLES, dtype=np.float64)
+  weights[K_VAL:] = 0.0
+  return particles, weights / np.sum(weights)
+
+class TestReSampler(unittest.TestCase):
+
+  '''
+    Integer particles are resampled in place, only into particles that had weight
+  '''
+  def test_int_particles(self):
+    np.random.seed(0)
+    for resample_type in RESAMPLE_TYPES:
+      particles, weights = make_particles()
+      rs = ReSampler(particles, weights)
+      getattr(rs, 'resample_' + resample_type)()
+      n_particles = rs.particles.shape[0]
+      self.assertTrue(np.all(rs.particles[:,0] == rs.particles[:,1]), resample_type)
+      self.assertTrue(np.all((rs.particles[:,0] > 0) & (rs.particles[:,0] < K_VAL)), resample_type)
+      self.assertTrue(np.allclose(rs.weights, 1.0 / n_particles), resample_type)
+      self.assertFalse(rs.state_lock.locked(), resample_type)
+
+  '''
+    Without a resize_cb, KLD sampling shrinks the particles to views of the arrays passed in
+  '''
+  def test_kld_without_resize_cb(self):
+    np.random.seed(0)
+    particles, weights = make_particles()
+    weights[:] = 0.0
+    weights[10] = 1.0 # Every particle falls into one bin, so KLD sampling keeps the fewest
+    rs = ReSampler(particles, weights, min_particles=5)
+    rs.resample_kld()
+    self.assertEqual(rs.particles.shape[0], 5)
+    self.assertEqual(rs.weights.shape[0], 5)
+    self.assertTrue(np.all(particles[:5] == 10))
+    self.assertRaises(ValueError, ReSampler, particles, weights, None, 1, 2 * N_PARTICLES)
+
+  '''
+    A resample that fails still releases state_lock
+  '''
+  def test_lock_released_on_error(self):
+    particles, weights = make_particles()
+    weights[:] = np.nan
+    rs = ReSampler(particles, weights)
+    self.assertRaises(ValueError, rs.resample_naiive)
+    self.assertFalse(rs.state_lock.locked())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import utils as Utils
+from nav_msgs.msg import OccupancyGrid
+from sensor_msgs.msg import LaserScan
+from ReSample import ReSampler
+from SensorModel import SensorModel
+
+MAP_SIZE = 100 # Width and height of the test map in pixels
+MAP_RESOLUTION = 0.05
+MAX_RANGE_METERS = 4.0
+N_PARTICLES = 200
+N_SCAN_RAYS = 360
+
+'''
+  Makes a square room with a wall in the middle
+  Returns: A nav_msgs/OccupancyGrid msg of the map
+'''
+def make_map():
+  grid = np.zeros((MAP_SIZE, MAP_SIZE), dtype=np.int8)
+  grid[0,:] = grid[-1,:] = grid[:,0] = grid[:,-1] = 100
+  grid[40:60,50] = 100
+
+  map_msg = OccupancyGrid()
+  map_msg.info.resolution = MAP_RESOLUTION
+  map_msg.info.width = MAP_SIZE
+  map_msg.info.height = MAP_SIZE
+  map_msg.info.origin.position.x = 0.0
+  map_msg.info.origin.position.y = 0.0
+  map_msg.info.origin.orientation = Utils.angle_to_quaternion(0.0)
+  map_msg.data = grid.ravel().tolist()
+  return map_msg
+
+'''
+  Makes a laser scan
+    ranges: The range of every ray
+    Returns: A sensor_msgs/LaserScan msg
+'''
+def make_scan(ranges):
+  msg = LaserScan()
+  msg.angle_min = -np.pi
+  msg.angle_increment = 2 * np.pi / N_SCAN_RAYS
+  msg.ranges = np.asarray(ranges, dtype=np.float32)
+  return msg
+
+'''
+  Makes a sensor model with particles spread over the room
+    kwargs: Passed on to SensorModel
+    Returns: The sensor model
+'''
+def make_sensor_model(**kwargs):
+  rng = np.random.RandomState(0)
+  particles = np.zeros((N_PARTICLES, 3))
+  particles[:,0] = rng.uniform(0.2, 4.8, N_PARTICLES)
+  particles[:,1] = rng.uniform(0.2, 4.8, N_PARTICLES)
+  particles[:,2] = rng.uniform(-np.pi, np.pi, N_PARTICLES)
+  weights = np.ones(N_PARTICLES) / N_PARTICLES
+  return SensorModel(None, 4, True, MAX_RANGE_METERS, make_map(), particles, weights,
+                     range_method_type='numpy', **kwargs)
+
+'''
+  Stands in for MotionModel, only tracking the accumulated motion
+'''
+class FakeMotionModel:
+
+  def __init__(self):
+    self.accum_translation = 0.0
+    self.accum_rotation = 0.0
+    self.n_motion_msgs = 0
+    self.n_applied = 0
+
+  def flush(self):
+    pass
+
+  def has_moved(self, min_d, min_a):
+    return self.accum_translation >= min_d or self.accum_rotation >= min_a
+
+  def reset_motion(self, translation, rotation):
+    self.accum_translation = max(self.accum_translation - translation, 0.0)
+    self.accum_rotation = max(self.accum_rotation - rotation, 0.0)
+
+class TestSensorModel(unittest.TestCase):
+
+  '''
+    A scan whose rays are all dropped must not fail or change the weights
+  '''
+  def test_every_ray_excluded(self):
+    ranges = np.full(N_SCAN_RAYS, MAX_RANGE_METERS, dtype=np.float32)
+    ranges[::7] = np.nan # Invalid rays are treated as max range
+    ranges[::11] = 0.0
+    configs = [{}, {'cascade_fraction': 0.3}, {'cascade_fraction': 0.3, 'range_cache_size': 100},
+               {'beam_budget': 30}, {'log_likelihood': True, 'cascade_fraction': 0.3}]
+    for config in configs:
+      sm = make_sensor_model(**config)
+      weights = sm.weights.copy()
+      sm.lidar_cb(make_scan(ranges))
+      self.assertEqual(sm.n_empty, 1, config)
+      self.assertFalse(sm.do_resample, config)
+      self.assertTrue(sm.do_publish, config)
+      np.testing.assert_array_equal(sm.weights, weights)
+
+  '''
+    A scan with a few hits still updates the weights
+  '''
+  def test_some_rays_excluded(self):
+    ranges = np.full(N_SCAN_RAYS, MAX_RANGE_METERS, dtype=np.float32)
+    ranges[::8] = 1.0
+    for config in [{}, {'cascade_fraction': 0.3}]:
+      sm = make_sensor_model(**config)
+      sm.lidar_cb(make_scan(ranges))
+      self.assertEqual(sm.n_empty, 0, config)
+      self.assertTrue(sm.do_resample, config)
+      self.assertAlmostEqual(np.sum(sm.weights), 1.0)
+      self.assertGreater(np.max(sm.weights), 1.0 / N_PARTICLES)
+
+  '''
+    Every selected beam is observed at the angle of the ray that measured it, like with laser_ray_step
+  '''
+  def test_beam_angles_match_rays(self):
+    rng = np.random.RandomState(2)
+    ranges = rng.uniform(0.5, 3.5, N_SCAN_RAYS).astype(np.float32)
+    scan = make_scan(ranges)
+    for config in [{}, {'beam_budget': 30}]:
+      sm = make_sensor_model(**config)
+      obs_ranges, obs_angles, hits = sm.preprocess_scan(scan)
+      ray_idxs = np.rint((obs_angles[hits] - scan.angle_min) / scan.angle_increment).astype(np.int64)
+      angle_errors = np.abs(obs_angles[hits] - sm.laser_angles[ray_idxs])
+      self.assertLess(np.max(angle_errors), 1e-6, config)
+      np.testing.assert_array_equal(obs_ranges[hits], ranges[ray_idxs])
+
+  '''
+    With the range cache, selecting beams casts the same angles for every scan, so the cache is reused
+  '''
+  def test_beam_angles_fixed(self):
+    rng = np.random.RandomState(1)
+    sm = make_sensor_model(beam_budget=30, range_cache_size=1000)
+    angles = []
+    for i in range(2):
+      ranges = rng.uniform(0.5, 3.5, N_SCAN_RAYS).astype(np.float32) # The median of each bin differs per scan
+      angles.append(sm.preprocess_scan(make_scan(ranges))[1].copy())
+      sm.lidar_cb(make_scan(ranges))
+    np.testing.assert_array_equal(angles[0], angles[1])
+    self.assertEqual(len(sm.range_method.angle_sets), 1)
+    self.assertEqual(sm.range_method.misses, N_PARTICLES)
+    self.assertEqual(sm.range_method.hits, N_PARTICLES)
+
+  '''
+    The likelihood field treats unknown cells as occupied, like the beam model's range methods
+  '''
+  def test_likelihood_field_unknown_cells(self):
+    unknown_map = make_map()
+    occupied_map = make_map()
+    grid = np.array(unknown_map.data, dtype=np.int8).reshape((MAP_SIZE, MAP_SIZE))
+    grid[70:80,20:30] = -1
+    unknown_map.data = grid.ravel().tolist()
+    grid[70:80,20:30] = 100
+    occupied_map.data = grid.ravel().tolist()
+
+    fields = []
+    for map_msg in [unknown_map, occupied_map]:
+      sm = make_sensor_model(sensor_model_type='likelihood_field')
+      fields.append(sm.precompute_likelihood_field(map_msg))
+    np.testing.assert_array_equal(fields[0], fields[1])
+
+  '''
+    The accumulated motion is only used up by an update that reaches the weights
+  '''
+  def test_motion_kept_until_applied(self):
+    ranges = np.full(N_SCAN_RAYS, 1.0, dtype=np.float32)
+    sm = make_sensor_model()
+    sm.motion_model = FakeMotionModel()
+    sm.force_update = False
+    sm.motion_model.accum_translation = 1.0
+
+    # Reinitializing the particles while the rays are cast discards the update
+    apply_sensor_model = sm.apply_sensor_model
+    def apply_and_reinitialize(*args):
+      apply_sensor_model(*args)
+      sm.discard_pending_update()
+      sm.motion_model.accum_translation += 0.25
+    sm.apply_sensor_model = apply_and_reinitialize
+    sm.lidar_cb(make_scan(ranges))
+    self.assertEqual(sm.n_discarded, 1)
+    self.assertEqual(sm.motion_model.accum_translation, 1.25)
+
+    # Motion made while the rays are cast still counts toward the next update
+    def apply_and_move(*args):
+      apply_sensor_model(*args)
+      sm.motion_model.accum_translation += 0.25
+    sm.apply_sensor_model = apply_and_move
+    sm.lidar_cb(make_scan(ranges))
+    self.assertEqual(sm.n_discarded, 1)
+    self.assertTrue(sm.do_resample)
+    self.assertEqual(sm.motion_model.accum_translation, 0.25)
+
+  '''
+    Copies made by a resample are cast once, until motion moves them apart
+  '''
+  def test_copies_cast_once(self):
+    np.random.seed(0)
+    ranges = np.full(N_SCAN_RAYS, 1.0, dtype=np.float32)
+    for config in [{}, {'cascade_fraction': 0.3}]:
+      sm = make_sensor_model(**config)
+      sm.motion_model = FakeMotionModel()
+      sm.resampler = ReSampler(sm.particles, sm.weights, sm.state_lock, motion_model=sm.motion_model)
+      sm.weights[:] = np.random.uniform(0, 1, N_PARTICLES) ** 8
+      sm.weights /= np.sum(sm.weights)
+      sm.resampler.resample_low_variance()
+      n_unique = np.unique(sm.resampler.chosen_idxs).shape[0]
+
+      # Every scan is applied to uniform weights, so the weights are the likelihoods
+      sm.lidar_cb(make_scan(ranges))
+      deduplicated = sm.weights.copy()
+      self.assertLess(sm.n_cast, N_PARTICLES, config)
+      if 'cascade_fraction' not in config:
+        self.assertEqual(sm.n_cast, n_unique)
+
+      sm.weights.fill(1.0 / N_PARTICLES)
+      sm.motion_model.n_applied += 1
+      sm.force_update = True
+      sm.lidar_cb(make_scan(ranges))
+      self.assertGreaterEqual(sm.n_cast, N_PARTICLES, config)
+      np.testing.assert_allclose(sm.weights, deduplicated, rtol=1e-6)
+
+if __name__ == '__main__':
+  unittest.main()
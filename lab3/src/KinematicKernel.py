@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import resource
+
+import numpy as np
+
+from timeit import default_timer as timer
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None # Python 2 cannot trace allocations, the benchmark counts page faults instead
+
+'''
+  Propagates particles through the kinematic car model in place. Every intermediate
+  result is written into scratch buffers that are only reallocated when the number of
+  particles changes, so a call does not allocate any particle sized arrays
+'''
+class KinematicKernel:
+
+  '''
+    Initializes the kernel
+      car_length: The length of the car
+  '''
+  def __init__(self, car_length):
+    self.CAR_LENGTH = car_length # The length of the car
+    self.half_dtheta = None # Scratch buffer, half of the change in heading of each particle
+    self.dtheta = None # Scratch buffer, the change in heading of each particle
+    self.scratch = None # Scratch buffer for trigonometry
+    self.straight = None # Scratch mask of particles that drive in a straight line
+
+  '''
+    Allocates the scratch buffers for n_particles particles
+      n_particles: The number of particles
+  '''
+  def allocate(self, n_particles):
+    self.half_dtheta = np.zeros(n_particles)
+    self.dtheta = np.zeros(n_particles)
+    self.scratch = np.zeros(n_particles)
+    self.straight = np.zeros(n_particles, dtype=bool)
+
+  '''
+    Moves every particle along the arc driven at its speed and steering angle for dt seconds,
+    adds the fixed noise and wraps the heading to [-pi, pi)
+      particles: Numpy array of dimension (N,3) of poses, updated in place
+      speeds: Numpy array of dimension (N,) of the speed of each particle, overwritten
+      deltas: Numpy array of dimension (N,) of the steering angle of each particle, overwritten
+      dt: The time step in seconds
+      x_noise: Numpy array of dimension (N,) of noise added to the x coordinates
+      y_noise: Numpy array of dimension (N,) of noise added to the y coordinates
+      theta_noise: Numpy array of dimension (N,) of noise added to the headings
+  '''
+  def propagate(self, particles, speeds, deltas, dt, x_noise, y_noise, theta_noise):
+    if self.dtheta is None or self.dtheta.shape[0] != particles.shape[0]:
+      self.allocate(particles.shape[0])
+    half_dtheta = self.half_dtheta
+    dtheta = self.dtheta
+    scratch = self.scratch
+
+    # With beta = arctan(tan(delta)/2), sin(2*beta) = tan(delta) / (1 + tan(delta)**2/4)
+    np.tan(deltas, out=deltas)
+    np.multiply(deltas, deltas, out=scratch)
+    scratch *= 0.25
+    scratch += 1.0
+    np.divide(deltas, scratch, out=deltas)
+
+    # The arc length and the change in heading
+    speeds *= dt
+    np.multiply(speeds, deltas, out=dtheta)
+    dtheta *= 1.0 / self.CAR_LENGTH
+
+    # The chord of the arc is arc_length * sin(dtheta/2)/(dtheta/2) long and points along
+    # theta + dtheta/2. This is the same as dividing by sin(2*beta), but has a finite limit
+    # (the straight line) when the car does not steer
+    np.multiply(dtheta, 0.5, out=half_dtheta)
+    np.sin(half_dtheta, out=scratch)
+    np.equal(half_dtheta, 0.0, out=self.straight)
+    np.copyto(scratch, 1.0, where=self.straight)
+    np.copyto(half_dtheta, 1.0, where=self.straight)
+    np.divide(scratch, half_dtheta, out=scratch)
+    speeds *= scratch # The chord length
+
+    np.multiply(dtheta, 0.5, out=half_dtheta)
+    half_dtheta += particles[:,2] # The heading of the chord
+    np.cos(half_dtheta, out=scratch)
+    scratch *= speeds
+    particles[:,0] += scratch
+    particles[:,0] += x_noise
+    np.sin(half_dtheta, out=scratch)
+    scratch *= speeds
+    particles[:,1] += scratch
+    particles[:,1] += y_noise
+
+    particles[:,2] += dtheta
+    particles[:,2] += theta_noise
+    wrap_angles(particles[:,2])
+
+'''
+  Wraps angles to [-pi, pi) in place
+    angles: Numpy array of angles in radians
+'''
+def wrap_angles(angles):
+  angles += np.pi
+  np.mod(angles, 2 * np.pi, out=angles)
+  angles -= np.pi
+
+'''
+  The original motion_cb propagation, only kept to compare the kernel against
+'''
+def propagate_reference(particles, speeds, deltas, dt, car_length, x_noise, y_noise, theta_noise):
+  beta = np.arctan(np.tan(deltas) * 0.5)
+  dtheta = speeds / car_length * np.sin(2 * beta) * dt
+  dx = car_length / np.sin(2 * beta) * (np.sin(particles[:,2] + dtheta) - np.sin(particles[:,2]))
+  dy = car_length / np.sin(2 * beta) * (-np.cos(particles[:,2] + dtheta) + np.cos(particles[:,2]))
+  particles[:,0] = particles[:,0] + dx + x_noise
+  particles[:,1] = particles[:,1] + dy + y_noise
+  particles[:,2] = particles[:,2] + dtheta + theta_noise
+
+'''
+  Measures the memory allocated by calling fn
+    fn: The function to call
+    Returns: (bytes allocated at peak, minor page faults) while calling fn, the bytes are None
+             when tracemalloc is unavailable
+'''
+def measure_allocations(fn):
+  if tracemalloc is not None:
+    tracemalloc.start()
+  faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+  fn()
+  faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults
+  peak = None
+  if tracemalloc is not None:
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+  return peak, faults
+
+'''
+  Microbenchmark of the kernel against the original propagation
+'''
+
+BENCHMARK_PARTICLES = [1000, 10000, 100000]
+BENCHMARK_CALLS = 200
+BENCHMARK_CAR_LENGTH = 0.33
+BENCHMARK_DT = 0.02
+
+if __name__ == '__main__':
+
+  for n_particles in BENCHMARK_PARTICLES:
+    particles = np.random.uniform(-np.pi, np.pi, (n_particles, 3))
+    noise = np.random.normal(0.0, 0.01, (3, n_particles))
+    controls = np.zeros((2, n_particles))
+    kernel = KinematicKernel(BENCHMARK_CAR_LENGTH)
+
+    # Controls are overwritten by the kernel, so both are handed fresh copies
+    def run_kernel():
+      controls[0] = 1.0
+      controls[1] = 0.2
+      kernel.propagate(particles, controls[0], controls[1], BENCHMARK_DT, noise[0], noise[1], noise[2])
+    def run_reference():
+      controls[0] = 1.0
+      controls[1] = 0.2
+      propagate_reference(particles, controls[0], controls[1], BENCHMARK_DT, BENCHMARK_CAR_LENGTH,
+                          noise[0], noise[1], noise[2])
+
+    for name, fn in [('reference', run_reference), ('kernel', run_kernel)]:
+      fn() # Warm up, the kernel allocates its scratch buffers on the first call
+      peak, faults = measure_allocations(fn)
+      start = timer()
+      for i in xrange(BENCHMARK_CALLS):
+        fn()
+      elapsed = (timer() - start) / BENCHMARK_CALLS
+      print('%d particles, %s: %f ms per call, %s bytes allocated, %d page faults'%(
+            n_particles, name, 1000.0 * elapsed, 'n/a' if peak is None else str(peak), faults))
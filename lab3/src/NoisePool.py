@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+from threading import Condition, Thread
+
+import numpy as np
+
+'''
+  Hands out standard normal noise that is pre-generated in large blocks on a background
+  thread, so that drawing noise is just a scaled copy. One block is handed out while the
+  other one is refilled. Blocks are always generated in the same order by the same seeded
+  generator, so the noise only depends on the seed and on how much was drawn
+'''
+class NoisePool:
+
+  '''
+    Initializes the pool and starts the refill thread
+      block_size: The number of normals in each of the two blocks
+      seed: Seed of the generator, None to seed from the OS
+  '''
+  def __init__(self, block_size, seed=None):
+    self.block_size = block_size
+    if hasattr(np.random, 'default_rng'):
+      self.rng = np.random.default_rng(seed)
+    else:
+      self.rng = np.random.RandomState(seed) # numpy < 1.17 has no Generator
+
+    self.blocks = [self.generate(), self.generate()] # The two blocks of standard normals
+    self.stale = [] # The blocks that were used up and wait to be refilled, oldest first
+    self.current = 0 # The block that noise is handed out from
+    self.pos = 0 # The first unused normal in the current block
+    self.n_waits = 0 # Number of times that a draw had to wait for a refill
+    self.cond = Condition() # Guards self.stale between the drawing thread and the refill thread
+
+    self.refill_thread = Thread(target=self.refill_loop)
+    self.refill_thread.daemon = True
+    self.refill_thread.start()
+
+  '''
+    Generates a block of standard normals
+      out: The block to overwrite, None to allocate a new one
+      Returns: The block
+  '''
+  def generate(self, out=None):
+    if out is None:
+      out = np.zeros(self.block_size)
+    if isinstance(self.rng, np.random.RandomState):
+      out[:] = self.rng.standard_normal(self.block_size)
+    else:
+      self.rng.standard_normal(out=out)
+    return out
+
+  '''
+    Refills used up blocks in the order they were used up, until the process exits
+  '''
+  def refill_loop(self):
+    while True:
+      with self.cond:
+        while len(self.stale) == 0:
+          self.cond.wait()
+        idx = self.stale[0] # Stays stale until it is refilled
+
+      self.generate(self.blocks[idx])
+
+      with self.cond:
+        self.stale.pop(0)
+        self.cond.notify_all()
+
+  '''
+    Hands the current block over to be refilled and switches to the other one, waiting
+    for it if it is still being refilled
+  '''
+  def swap(self):
+    with self.cond:
+      self.stale.append(self.current)
+      self.current = 1 - self.current
+      if self.current in self.stale:
+        self.n_waits += 1
+      self.cond.notify_all()
+      while self.current in self.stale:
+        self.cond.wait()
+    self.pos = 0
+
+  '''
+    Fills out with normal noise. Only one thread may draw from a pool
+      loc: The mean of the noise
+      scale: The standard deviation of the noise
+      out: Numpy array of dimension (N,) that is filled with the noise
+      Returns: out
+  '''
+  def normal(self, loc, scale, out):
+    filled = 0
+    while filled < out.shape[0]:
+      if self.pos == self.block_size:
+        self.swap()
+      n = min(out.shape[0] - filled, self.block_size - self.pos)
+      np.multiply(self.blocks[self.current][self.pos:self.pos+n], scale, out=out[filled:filled+n])
+      self.pos += n
+      filled += n
+    out += loc
+    return out
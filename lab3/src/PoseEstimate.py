@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import numpy as np
+
+from timeit import default_timer as timer
+
+'''
+  Computes the weighted mean pose of the particles
+  Uses weighted cosine and sine averaging to more accurately compute average theta
+    https://en.wikipedia.org/wiki/Mean_of_circular_quantities
+    particles: Numpy array of dimension (N,3) of poses
+    weights: Numpy array of dimension (N,) of weights that sum to one
+    Returns: A 3 element numpy array of the mean pose
+'''
+def weighted_mean_pose(particles, weights):
+  x = np.dot(weights, particles[:,0])
+  y = np.dot(weights, particles[:,1])
+  theta = np.arctan2(np.dot(weights, np.sin(particles[:,2])), np.dot(weights, np.cos(particles[:,2])))
+  return np.array([x, y, theta])
+
+'''
+  Computes the weighted mean pose of the heaviest cluster of particles. The particles are binned
+  on a coarse (x, y) grid, and the cluster is the heaviest cell together with the cells around it,
+  so that a mode split by a cell boundary is not cut in half. When the particles disagree between
+  two places, the pose is that of the more likely place instead of somewhere in between
+    particles: Numpy array of dimension (N,3) of poses
+    weights: Numpy array of dimension (N,) of weights that sum to one
+    cell_size: The side length of the grid cells in meters
+    Returns: A 3 element numpy array of the mean pose of the cluster
+'''
+def clustered_pose(particles, weights, cell_size):
+  cells = np.floor(particles[:,:2] / cell_size).astype(np.int64)
+  rows = cells.view(np.dtype((np.void, cells.dtype.itemsize * cells.shape[1]))).ravel()
+  _, first_idxs, inverse = np.unique(rows, return_index=True, return_inverse=True)
+  cell_weights = np.bincount(inverse.ravel(), weights=weights)
+  best_cell = cells[first_idxs[np.argmax(cell_weights)]]
+
+  in_cluster = np.all(np.abs(cells - best_cell) <= 1, axis=1)
+  cluster_weights = weights[in_cluster]
+  return weighted_mean_pose(particles[in_cluster], cluster_weights / np.sum(cluster_weights))
+
+'''
+  The original expected_pose, only kept to compare against. Note that its theta is unweighted
+'''
+def expected_pose_reference(particles, weights):
+  x = np.sum([weights[i] * particles[i][0] for i in range(len(particles))])
+  y = np.sum([weights[i] * particles[i][1] for i in range(len(particles))])
+  theta = np.arctan2(np.sum([np.sin(particles[i][2]) for i in range(len(particles))]), np.sum([np.cos(particles[i][2]) for i in range(len(particles))]))
+  return np.array([x, y, theta])
+
+'''
+  Times the pose estimates for particles that are split between two parallel corridors
+'''
+
+BENCHMARK_PARTICLES = 10000
+BENCHMARK_CALLS = 20
+BENCHMARK_CELL_SIZE = 1.0
+BENCHMARK_CORRIDORS = [(0.0, 0.6), (4.0, 0.4)] # (y, fraction of the weight) of each corridor
+
+if __name__ == '__main__':
+
+  particles = np.zeros((BENCHMARK_PARTICLES, 3))
+  particles[:,0] = np.random.uniform(0.0, 2.0, BENCHMARK_PARTICLES)
+  particles[:,2] = np.random.normal(0.0, 0.1, BENCHMARK_PARTICLES)
+  weights = np.zeros(BENCHMARK_PARTICLES)
+  half = BENCHMARK_PARTICLES // 2
+  for i, (y, fraction) in enumerate(BENCHMARK_CORRIDORS):
+    particles[i*half:(i+1)*half,1] = np.random.normal(y, 0.2, half)
+    weights[i*half:(i+1)*half] = fraction / half
+
+  estimators = [('reference', lambda: expected_pose_reference(particles, weights)),
+                ('weighted mean', lambda: weighted_mean_pose(particles, weights)),
+                ('clustered', lambda: clustered_pose(particles, weights, BENCHMARK_CELL_SIZE))]
+  for name, fn in estimators:
+    start = timer()
+    for i in xrange(BENCHMARK_CALLS):
+      pose = fn()
+    elapsed = (timer() - start) / BENCHMARK_CALLS
+    print('%d particles, %s: %f ms per call, pose %s'%(BENCHMARK_PARTICLES, name, 1000.0 * elapsed, pose))
@@ -2,7 +2,6 @@
 
 from __future__ import division
 
-import random
 from threading import Lock
 
 import matplotlib.pyplot as plt
@@ -10,6 +9,10 @@ import numpy as np
 
 import rospy
 
+KLD_EPSILON = 0.05 # Max KL divergence between the sampled and the true distribution in KLD sampling
+KLD_Z = 2.33 # Upper 1-delta quantile of the standard normal, delta = 0.01 is the probability that the bound fails
+KLD_BIN_SIZE = np.array([0.5, 0.5, np.radians(10.0)]) # Size of the (x, y, theta) histogram bins in KLD sampling
+RESIDUAL_ROUNDING_TOL = 1e-9 # Copies that N*w falls short of by rounding error alone are still made deterministically
 
 '''
   Provides methods for re-sampling from a distribution represented by weighted samples
@@ -21,31 +24,69 @@ class ReSampler:
     particles: The particles to sample from
     weights: The weights of each particle
     state_lock: Controls access to particles and weights
+    min_particles: The fewest particles that KLD sampling keeps
+    max_particles: The most particles that KLD sampling keeps, defaults to the number of particles
+    resize_cb: Called with the new number of particles (and state_lock held) when KLD sampling
+               changes it. Must replace the particles and weights everywhere they are shared with
+               views of that length, including by calling set_particles. Without it, the particles
+               and weights become views of the first rows of the arrays passed in, so max_particles
+               cannot be more than their length
+    motion_model: The motion model that moves the particles, if any. Resampling records how much
+                  motion it had applied, so that the sensor model can tell whether the copies made
+                  by the resample are still exact
   '''
-  def __init__(self, particles, weights, state_lock=None):
+  def __init__(self, particles, weights, state_lock=None, min_particles=1, max_particles=None, resize_cb=None,
+               motion_model=None):
     self.particles = particles
     self.weights = weights
+    self.MIN_PARTICLES = min_particles # The fewest particles that KLD sampling keeps
+    self.MAX_PARTICLES = max_particles if max_particles is not None else particles.shape[0] # The most particles that KLD sampling keeps
+    self.resize_cb = resize_cb
+    self.motion_model = motion_model
+    self.particle_buffer = particles # The particles become views of its first rows if there is no resize_cb
+    self.weight_buffer = weights # The weights become views of its first rows if there is no resize_cb
+    if self.resize_cb is None and self.MAX_PARTICLES > particles.shape[0]:
+      raise ValueError('max_particles can only exceed the number of particles with a resize_cb')
 
     # For speed purposes, you may wish to add additional member variable(s) that
     # cache computations that will be reused in the re-sampling functions
     # YOUR CODE HERE?
-    self.prev_particles = self.particles.copy()
-    self.particle_idxs = range(len(self.prev_particles))
+    self.prev_particles = np.zeros((self.MAX_PARTICLES, particles.shape[1]), dtype=particles.dtype) # Preallocated buffer that the chosen particles are gathered into
+    self.particle_idxs = None
+    self.chosen_idxs = None # Index of the particle that each particle was copied from by the last resample
+    self.motion_stamp = None # The n_applied of the motion model at the last resample
+    self.step_positions = None # Offsets of the low variance sampling positions
+    self.set_particles(particles, weights)
+    self.n_resamples = 0 # Number of times the particles were resampled, lets other code notice reordering
     if state_lock is None:
       self.state_lock = Lock()
     else:
       self.state_lock = state_lock
 
+  '''
+    Replaces the particles and weights that are resampled, e.g. because their number changed.
+    The caller should hold state_lock
+      particles: The particles to sample from, at most max_particles of them
+      weights: The weights of each particle
+  '''
+  def set_particles(self, particles, weights):
+    self.particles = particles
+    self.weights = weights
+    self.particle_idxs = np.arange(len(self.particles))
+    self.step_positions = np.arange(len(self.particles)) / float(len(self.particles))
+
   '''
     Performs independently, identically distributed in-place sampling of particles
   '''
   def resample_naiive(self):
     self.state_lock.acquire()
-    # YOUR CODE HERE
-    self.prev_particles = self.particles.copy()
-    chosen_idxs = np.random.choice(self.particle_idxs, size=len(self.particles), replace=True, p=self.weights)
-    self.particles[:] = [self.prev_particles[i] for i in chosen_idxs]
-    self.state_lock.release()
+    try:
+      # YOUR CODE HERE
+      chosen_idxs = np.random.choice(self.particle_idxs, size=len(self.particles), replace=True, p=self.weights)
+      self.gather(chosen_idxs)
+      self.n_resamples += 1
+    finally:
+      self.state_lock.release()
 
   '''
     Performs in-place, lower variance sampling of particles
@@ -53,19 +94,140 @@ class ReSampler:
   '''
   def resample_low_variance(self):
     self.state_lock.acquire()
+    try:
+      # YOUR CODE HERE
+      r = np.random.uniform(0,1/float(len(self.particles)))
+
+      # Particle i is chosen for every position U = r + m/N with c[i-1] < U <= c[i]. Scaling the
+      # positions by the total weight keeps floating point drift from running past the last particle
+      c = np.cumsum(self.weights)
+      U = (self.step_positions + r) * c[-1]
+      chosen_idxs = np.searchsorted(c, U, side='left')
+      np.minimum(chosen_idxs, len(self.particles) - 1, out=chosen_idxs)
+      self.gather(chosen_idxs)
+      self.n_resamples += 1
+    finally:
+      self.state_lock.release()
+
+  '''
+    Performs in-place stratified sampling of particles. Like low variance sampling, one position
+    falls into each of the N equal strata of the cumulative weights, but every position is drawn
+    independently within its stratum
+  '''
+  def resample_stratified(self):
+    self.state_lock.acquire()
+    try:
+      c = np.cumsum(self.weights)
+      U = np.random.uniform(0, 1/float(len(self.particles)), len(self.particles))
+      U += self.step_positions
+      U *= c[-1]
+      chosen_idxs = np.searchsorted(c, U, side='left')
+      np.minimum(chosen_idxs, len(self.particles) - 1, out=chosen_idxs)
+      self.gather(chosen_idxs)
+      self.n_resamples += 1
+    finally:
+      self.state_lock.release()
+
+  '''
+    Performs in-place residual sampling of particles. Each particle is copied floor(N*w) times
+    deterministically, and the remaining slots are filled by naiive sampling of the leftover weights
+  '''
+  def resample_residual(self):
+    self.state_lock.acquire()
+    try:
+      n_particles = len(self.particles)
+      expected = self.weights * (n_particles / np.sum(self.weights))
+      counts = np.floor(expected + RESIDUAL_ROUNDING_TOL).astype(np.int64)
+      expected -= counts
+      np.maximum(expected, 0.0, out=expected) # The residual weights
+      n_residual = n_particles - np.sum(counts)
+
+      chosen_idxs = np.repeat(self.particle_idxs, counts)
+      if n_residual > 0:
+        c = np.cumsum(expected)
+        residual_idxs = np.searchsorted(c, np.random.uniform(0, c[-1], n_residual), side='left')
+        np.minimum(residual_idxs, n_particles - 1, out=residual_idxs)
+        chosen_idxs = np.concatenate((chosen_idxs, residual_idxs))
+      self.gather(chosen_idxs[:n_particles])
+      self.n_resamples += 1
+    finally:
+      self.state_lock.release()
+
+  '''
+    Replaces the particles in place with the chosen ones and resets the weights in place to be
+    uniform. The particles and weights arrays are shared with the rest of the particle filter,
+    so they are never swapped out. The chosen rows are gathered into self.prev_particles and
+    copied back instead, which does not allocate. The chosen indices are kept so that the
+    sensor model can find the copies without sorting the poses. The caller should hold state_lock
+      chosen_idxs: Numpy array of the index of the particle chosen for each slot
+  '''
+  def gather(self, chosen_idxs):
+    # mode='clip' lets np.take write straight into out, mode='raise' would buffer it
+    n_chosen = chosen_idxs.shape[0]
+    self.chosen_idxs = chosen_idxs
+    self.motion_stamp = self.motion_model.n_applied if self.motion_model is not None else None
+    np.take(self.particles, chosen_idxs, axis=0, out=self.prev_particles[:n_chosen], mode='clip')
+    if n_chosen != self.particles.shape[0]:
+      if self.resize_cb is not None:
+        self.resize_cb(n_chosen)
+      else:
+        self.set_particles(self.particle_buffer[:n_chosen], self.weight_buffer[:n_chosen])
+    np.copyto(self.particles, self.prev_particles[:n_chosen])
+    self.weights.fill(1.0 / self.weights.shape[0])
+
+  '''
+    Forgets which particles are copies of each other, e.g. because the particles were
+    reinitialized. The caller should hold state_lock
+  '''
+  def forget_copies(self):
+    self.chosen_idxs = None
+
+  '''
+    Performs KLD sampling (Fox 2003): draws particles i.i.d. until there are enough of them that,
+    with probability 1-delta, the KL divergence between the sampled and the true distribution is
+    at most KLD_EPSILON, judging by how many (x, y, theta) histogram bins the samples occupy.
+    The number of particles changes to between min_particles and max_particles
+  '''
+  def resample_kld(self):
+    self.state_lock.acquire()
+    try:
+      # Draw as many candidates as could be needed at once. Taking the first n of them is the
+      # same as drawing one at a time and stopping after n
+      c = np.cumsum(self.weights)
+      candidate_idxs = np.searchsorted(c, np.random.uniform(0, c[-1], self.MAX_PARTICLES), side='left')
+      np.minimum(candidate_idxs, len(self.particles) - 1, out=candidate_idxs)
+
+      # The number of occupied bins after each candidate
+      bins = np.floor(self.particles[candidate_idxs] / KLD_BIN_SIZE).astype(np.int64)
+      rows = bins.view(np.dtype((np.void, bins.dtype.itemsize * bins.shape[1]))).ravel()
+      _, first_idxs = np.unique(rows, return_index=True)
+      new_bin = np.zeros(self.MAX_PARTICLES, dtype=bool)
+      new_bin[first_idxs] = True
+      n_bins = np.cumsum(new_bin)
+
+      # Stop at the first candidate where the sample is as large as the bound for its bin count
+      n_required = np.maximum(kld_bound(n_bins), self.MIN_PARTICLES)
+      satisfied = np.nonzero(np.arange(1, self.MAX_PARTICLES + 1) >= n_required)[0]
+      n_particles = satisfied[0] + 1 if satisfied.shape[0] > 0 else self.MAX_PARTICLES
 
-    # YOUR CODE HERE
-    self.prev_particles = self.particles.copy()
-    r = random.uniform(0,1/float(len(self.particles)))
-    c = self.weights[0]
-    i = 0
-    for m in range(len(self.particles)):
-        U = r + m * (1/float(len(self.particles)))
-        while U > c:
-            i += 1
-            c += self.weights[i]
-        self.particles[m] = self.prev_particles[i]
-    self.state_lock.release()
+      self.gather(candidate_idxs[:n_particles])
+      self.n_resamples += 1
+    finally:
+      self.state_lock.release()
+
+'''
+  Computes the number of samples that KLD sampling needs for the sample to be within KLD_EPSILON
+  of the true distribution with probability 1-delta, using the Wilson-Hilferty approximation of
+  the chi-square quantile
+    n_bins: Numpy array of the number of occupied histogram bins
+    Returns: Numpy array of the number of samples needed for each number of bins
+'''
+def kld_bound(n_bins):
+  k = np.maximum(n_bins - 1, 1).astype(np.float64)
+  a = 2.0 / (9.0 * k)
+  n_required = k / (2.0 * KLD_EPSILON) * np.power(1.0 - a + np.sqrt(a) * KLD_Z, 3)
+  n_required[n_bins <= 1] = 0 # A single bin is matched exactly by any sample
+  return n_required
 
 import matplotlib.pyplot as plt
 
@@ -75,7 +237,7 @@ if __name__ == '__main__':
 
   n_particles = int(rospy.get_param("~n_particles",100)) # The number of particles
   k_val = int(rospy.get_param("~k_val", 80)) # Number of particles that have non-zero weight
-  resample_type = rospy.get_param("~resample_type", "naiive") # Whether to use naiive or low variance sampling
+  resample_type = rospy.get_param("~resample_type", "naiive") # Whether to use naiive, low variance, stratified or residual sampling
   trials = int(rospy.get_param("~trials", 10)) # The number of re-samplings to do
 
   histogram = np.zeros(n_particles, dtype=np.float) # Keeps track of how many times
@@ -97,6 +259,10 @@ if __name__ == '__main__':
       rs.resample_naiive()
     elif resample_type == "low_variance":
       rs.resample_low_variance()
+    elif resample_type == "stratified":
+      rs.resample_stratified()
+    elif resample_type == "residual":
+      rs.resample_residual()
     else:
       print "Unrecognized resampling method: "+ resample_type
 
@@ -2,19 +2,19 @@
 
 from __future__ import division
 
-import math
 import time
-from threading import Lock
+from threading import Condition, Lock
 
 import matplotlib.pyplot as plt
 import numpy as np
-import range_libc
 
 from timeit import default_timer as timer
 import rosbag
 import rospy
 import utils as Utils
 from nav_msgs.srv import GetMap
+from RangeMethods import SHARDED_RANGE_METHODS, CachedRangeMethod, ShardedRangeMethod, make_range_method
+from rospy.numpy_msg import numpy_msg
 from sensor_msgs.msg import LaserScan
 
 THETA_DISCRETIZATION = 112 # Discretization of scanning angle
@@ -27,6 +27,13 @@ Z_RAND = 0.3 # Weight for random reading
 SIGMA_HIT = 1 # Noise value for hit reading
 Z_HIT =  0.5 # Weight for hit reading
 
+SENSOR_MODEL_TYPES = ['beam', 'likelihood_field'] # The sensor models that can be applied to the particles
+LF_Z_HIT = 0.8 # Likelihood field weight for an endpoint near an obstacle
+LF_Z_RAND = 0.2 # Likelihood field weight for a random endpoint
+LF_SIGMA_HIT = 0.1 # Likelihood field noise in meters of the distance from an endpoint to the nearest obstacle
+UNIQUE_CAST_MAX_FRACTION = 0.75 # Only cast unique poses when at most this fraction of the particles are unique
+CASCADE_COARSE_STEP = 4 # Every how many of the downsampled rays are used to coarsely score particles in cascade mode
+
 ''' 
   Weights particles according to their agreement with the observed data
 '''
@@ -34,7 +41,7 @@ class SensorModel:
 	
   '''
   Initializes the sensor model
-    scan_topic: The topic containing laser scans
+    scan_topic: The topic containing laser scans, None to not subscribe (e.g. to replay scans offline)
     laser_ray_step: Step for downsampling laser scans
     exclude_max_range_rays: Whether to exclude rays that are beyond the max range
     max_range_meters: The max range of the laser
@@ -42,77 +49,337 @@ class SensorModel:
     particles: The particles to be weighted
     weights: The weights of the particles
     state_lock: Used to control access to particles and weights
+    range_method_type: The ray casting backend, one of RangeMethods.RANGE_METHODS
+    sensor_model_type: The sensor model, one of SENSOR_MODEL_TYPES
+    range_cache_size: Number of expected range vectors to memoize by quantized pose, 0 disables the cache
+    cascade_fraction: Fraction of the particles that are rescored with every ray after a coarse pass
+                      over all of them, 0 disables the cascade
+    beam_budget: Number of angular bins to select one informative ray from, 0 uses every laser_ray_step-th ray instead.
+                 With the range cache, each bin is cast at a fixed angle instead of the angle of its selected ray
+    motion_model: The KinematicMotionModel whose accumulated motion gates sensor updates, None to update on every scan
+    update_min_d: Translation in meters required before a sensor update
+    update_min_a: Rotation in radians required before a sensor update
+    resampler: The ReSampler that reorders the particles, used to detect resampling during a sensor update
+    log_likelihood: Whether to evaluate the sensor model as a sum of log-probabilities instead of a product of probabilities
+    n_workers: Number of threads that ray cast and evaluate blocks of particles in parallel, 1 uses the calling thread.
+               Only used by the range methods in SHARDED_RANGE_METHODS, the others always use the calling thread
+    resample_ess_fraction: Only ask for resampling once the effective sample size falls below this fraction of
+                           the number of particles, 1 asks after every sensor update
   '''
   def __init__(self, scan_topic, laser_ray_step, exclude_max_range_rays, 
-               max_range_meters, map_msg, particles, weights, state_lock=None):
+               max_range_meters, map_msg, particles, weights, state_lock=None,
+               range_method_type='cddt', sensor_model_type='beam', range_cache_size=0,
+               cascade_fraction=0.0, beam_budget=0, motion_model=None,
+               update_min_d=0.0, update_min_a=0.0, resampler=None, log_likelihood=False,
+               n_workers=1, resample_ess_fraction=1.0):
     if state_lock is None:
       self.state_lock = Lock()
     else:
       self.state_lock = state_lock
+    self.update_cond = Condition(self.state_lock) # Notified whenever do_resample, do_publish or shutdown is set
+    self.shutdown = False # Set on ROS shutdown so that wait_for_update returns
+    rospy.on_shutdown(self.shutdown_cb)
   
     self.particles = particles
     self.weights = weights
     
     self.LASER_RAY_STEP = laser_ray_step # Step for downsampling laser scans
     self.EXCLUDE_MAX_RANGE_RAYS = exclude_max_range_rays # Whether to exclude rays that are beyond the max range
+    self.BEAM_BUDGET = beam_budget # Max number of informative rays to select per scan, 0 to downsample by LASER_RAY_STEP
+    self.FIXED_BEAM_ANGLES = range_cache_size > 0 # Whether selected beams are cast at the fixed angle of their bin, so that the range cache is reused
     self.MAX_RANGE_METERS = max_range_meters # The max range of the laser
+    self.UPDATE_MIN_D = update_min_d # Translation in meters required before a sensor update
+    self.UPDATE_MIN_A = update_min_a # Rotation in radians required before a sensor update
+    self.motion_model = motion_model
+    self.resampler = resampler
+    self.SENSOR_MODEL_TYPE = sensor_model_type # Whether to use the beam or the likelihood field model
+    self.CASCADE_FRACTION = cascade_fraction # Fraction of the particles rescored with every ray in cascade mode
+    self.LOG_LIKELIHOOD = log_likelihood # Whether weights are computed as squashed log-likelihoods that cannot underflow
+    self.RESAMPLE_ESS_FRACTION = resample_ess_fraction # Fraction of the particles that the effective sample size must fall below to resample
+    self.map_info = map_msg.info
     
-    oMap = range_libc.PyOMap(map_msg) # A version of the map that range_libc can understand
-    max_range_px = int(self.MAX_RANGE_METERS / map_msg.info.resolution) # The max range in pixels of the laser
-    self.range_method = range_libc.PyCDDTCast(oMap, max_range_px, THETA_DISCRETIZATION) # The range method that will be used for ray casting
-    #self.range_method = range_libc.PyRayMarchingGPU(oMap, max_range_px) # The range method that will be used for ray casting
-    self.range_method.set_sensor_model(self.precompute_sensor_model(max_range_px)) # Load the sensor model expressed as a table
+    self.range_method = None # The range method that will be used for ray casting, only needed by the beam model
+    self.likelihood_field = None # Flattened likelihood of an endpoint in each map cell, only needed by the likelihood field model
+    self.log_sensor_model_table = None # Squashed float32 log of the sensor model table, only needed by the beam model in log-likelihood mode
+    if self.SENSOR_MODEL_TYPE == 'beam':
+      max_range_px = int(self.MAX_RANGE_METERS / map_msg.info.resolution) # The max range in pixels of the laser
+      self.range_method = make_range_method(range_method_type, map_msg, max_range_px, THETA_DISCRETIZATION)
+      if n_workers > 1 and range_method_type in SHARDED_RANGE_METHODS:
+        self.range_method = ShardedRangeMethod(self.range_method, n_workers) # Shard below the cache, which is not thread safe
+      elif n_workers > 1:
+        rospy.logwarn('The %s range method is not sharded, ignoring n_workers = %d'%(range_method_type, n_workers))
+      if range_cache_size > 0:
+        self.range_method = CachedRangeMethod(self.range_method, map_msg.info, range_cache_size, THETA_DISCRETIZATION)
+      sensor_model_table = self.precompute_sensor_model(max_range_px)
+      self.range_method.set_sensor_model(sensor_model_table) # Load the sensor model expressed as a table
+      if self.LOG_LIKELIHOOD:
+        # Squashing w**INV_SQUASH_FACTOR is a scalar multiply of the log, so fold it into the table
+        self.log_sensor_model_table = (INV_SQUASH_FACTOR * np.log(sensor_model_table)).astype(np.float32)
+    elif self.SENSOR_MODEL_TYPE == 'likelihood_field':
+      self.likelihood_field = self.precompute_likelihood_field(map_msg)
+      if self.LOG_LIKELIHOOD:
+        self.likelihood_field = INV_SQUASH_FACTOR * np.log(self.likelihood_field)
+    else:
+      raise ValueError('Unrecognized sensor model: ' + self.SENSOR_MODEL_TYPE)
     self.queries = None # Do not modify this variable
     self.ranges = None # Do not modify this variable
+    self.unique_weights = None # Weights of the unique poses before they are scattered to every copy
+    self.fine_weights = None # Weights of the particles that are rescored with every ray in cascade mode
+    self.n_cast = 0 # Number of poses that were ray cast by the last sensor update
+    self.chosen_idxs = None # Index that the last resample copied each particle from, None unless the copies are still exact
     self.laser_angles = None # The angles of each ray
     self.downsampled_angles = None # The angles of the downsampled rays 
+    self.scan_geometry = None # (angle_min, angle_increment, number of rays) that the cached angles were computed for
+    self.ray_idxs = None # Indices of the downsampled rays within a full scan
+    self.obs_ranges = None # Preallocated buffer holding the downsampled ranges of the latest scan
+    self.invalid_rays = None # Preallocated mask of downsampled rays that are NaN or 0.0
+    self.zero_rays = None # Scratch mask of downsampled rays that are 0.0
+    self.hit_rays = None # Preallocated mask of downsampled rays that are short of max range
+    self.hit_ranges = None # Expected ranges of the rays in self.hit_rays, gathered for the sensor model
+    self.beam_bin_idxs = None # Indices of the rays in each angular bin used for beam selection
+    self.beam_bin_pad = None # Mask of the entries of self.beam_bin_idxs that only pad a bin
+    self.beam_angles = None # The fixed angle that is cast for each angular bin used for beam selection if self.FIXED_BEAM_ANGLES is set
+    self.selected_angles = None # Preallocated buffer holding the angle of the ray selected from each angular bin
+    self.beam_ranges = None # Preallocated buffer holding the range selected from each angular bin
+    self.beam_hits = None # Preallocated mask of the angular bins that have a valid ray
     self.do_resample = False # Set so that outside code can know that it's time to resample
+    self.do_publish = False # Set so that outside code can know that a scan arrived but the update was skipped
+    self.force_update = True # Set to apply the sensor model to the next scan regardless of motion
+    self.n_skipped = 0 # Number of scans that were skipped because the car did not move enough
+    self.n_empty = 0 # Number of scans that were skipped because no rays were left to weight the particles with
+    self.snapshot = None # Copy of the particles that the sensor model is applied to, so that motion updates can continue meanwhile
+    self.pending_weights = None # Weights computed for self.snapshot, copied into self.weights once the update finishes
+    self.update_generation = 0 # Incremented whenever the particles are reinitialized, see discard_pending_update
+    self.n_merged_motion = 0 # Number of motion updates that were applied to the particles while a sensor update ran
+    self.n_discarded = 0 # Number of sensor updates discarded because the particles were resampled or reinitialized meanwhile
+    self.ess = None # Effective sample size 1/sum(w**2) of the weights after the last sensor update
+    self.n_carried = 0 # Number of sensor updates whose weights were carried forward instead of resampled
     
-    # Subscribe to laser scans
-    self.laser_sub = rospy.Subscriber(scan_topic, LaserScan, self.lidar_cb, queue_size=1)    
+    # Subscribe to laser scans. numpy_msg deserializes ranges straight into a float32 array
+    self.laser_sub = None
+    if scan_topic is not None:
+      self.laser_sub = rospy.Subscriber(scan_topic, numpy_msg(LaserScan), self.lidar_cb, queue_size=1)    
 
   '''
     Downsamples laser measurements and applies sensor model
       msg: A sensor_msgs/LaserScan
   '''    
   def lidar_cb(self, msg):
+    # Preprocessing only touches scan buffers, so do it before taking the lock
+    obs = self.preprocess_scan(msg)
+
     self.state_lock.acquire()
- 
-    # Compute the observation obs
-    #   obs is a a two element tuple
-    #   obs[0] is the downsampled ranges
-    #   obs[1] is the downsampled angles
-    #   Note it should be the case that obs[0].shape[0] == obs[1].shape[0]
-    #   Each element of obs must be a numpy array of type np.float32
-    #   Use self.LASER_RAY_STEP as the downsampling step
-    #   Keep efficiency in mind, including by caching certain things that won't change across future iterations of this callback
-    #   and vectorizing computations as much as possible
-    #   Set all range measurements that are NAN or 0.0 to self.MAX_RANGE_METERS
-    #   You may choose to use self.laser_angles and self.downsampled_angles here
-    # YOUR CODE HERE
-  
-    self.laser_angles = np.linspace(msg.angle_min, msg.angle_max, len(msg.ranges), dtype=float)
-    self.downsampled_angles = np.array(self.laser_angles[::self.LASER_RAY_STEP])
-    obs_ranges = np.array(msg.ranges[::self.LASER_RAY_STEP], dtype=float )
-    if(len(self.downsampled_angles) != len(obs_ranges)):
-      print("Array dimension mismatch")
+    self.last_laser = msg
 
-    for x in range(len(obs_ranges) ):
-      if(math.isnan(obs_ranges[x]) or obs_ranges[x]==0 ):
-        obs_ranges[x] = self.MAX_RANGE_METERS
+    # Every ray was dropped, e.g. because every return was at max range with exclude_max_range_rays,
+    # so the scan says nothing about the particles. Keep the weights and the accumulated motion
+    n_rays = obs[1].shape[0] if obs[2] is None else np.count_nonzero(obs[2])
+    if n_rays == 0:
+      self.n_empty += 1
+      self.do_publish = True
+      self.update_cond.notify_all()
+      self.state_lock.release()
+      return
+
+    # Like AMCL's update_min_d/update_min_a, only update once the car moved enough. Updating a
+    # still car just burns CPU and collapses the particles through repeated resampling
+    if (not self.force_update and self.motion_model is not None and
+        not self.motion_model.has_moved(self.UPDATE_MIN_D, self.UPDATE_MIN_A)):
+      self.n_skipped += 1
+      self.do_publish = True
+      self.update_cond.notify_all()
+      self.state_lock.release()
+      return
+    self.force_update = False
+    if self.motion_model is not None:
+      self.motion_model.flush() # Apply any motion that was coalesced since the last scan
+
+    # Apply the sensor model to a snapshot of the particles without holding the lock, so that
+    # motion updates are not blocked (and dropped) while rays are cast. The likelihoods belong to
+    # each particle regardless of how it moves meanwhile, so they are merged back afterward
+    if self.snapshot is None or self.snapshot.shape != self.particles.shape:
+      self.snapshot = np.zeros_like(self.particles)
+      self.pending_weights = np.zeros_like(self.weights)
+    self.snapshot[:] = self.particles
+    generation = self.update_generation
+    n_resamples = self.resampler.n_resamples if self.resampler is not None else 0
+    n_motion_msgs = self.motion_model.n_motion_msgs if self.motion_model is not None else 0
+    # Motion updates move every copy that the last resample made with its own noise, so the
+    # copies are only exact while no motion was applied since. That happens when no motion gate
+    # is set and a scan arrives before the first servo msg or before the next vesc state msg
+    self.chosen_idxs = None
+    n_applied = self.motion_model.n_applied if self.motion_model is not None else None
+    if self.resampler is not None and self.resampler.motion_stamp == n_applied:
+      self.chosen_idxs = self.resampler.chosen_idxs
+    if self.motion_model is not None:
+      moved = (self.motion_model.accum_translation, self.motion_model.accum_rotation) # Motion that this update accounts for
+    self.state_lock.release()
 
+    self.apply_sensor_model(self.snapshot, obs, self.pending_weights)
+    if self.LOG_LIKELIHOOD:
+      # Log-sum-exp: shifting by the max log-likelihood makes the best particle exp(0) = 1,
+      # so the weights cannot all underflow to zero however many rays there are
+      self.pending_weights -= np.max(self.pending_weights)
+      np.exp(self.pending_weights, out=self.pending_weights)
 
-    obs = np.row_stack((obs_ranges,self.downsampled_angles))    
-    obs = np.float32(obs)
+    self.state_lock.acquire()
+    if (generation != self.update_generation or
+        (self.resampler is not None and n_resamples != self.resampler.n_resamples)):
+      # The particles no longer line up with the snapshot. Keep the accumulated motion and
+      # force the next update so that it is not skipped by the motion gate
+      self.n_discarded += 1
+      self.force_update = True
+      self.state_lock.release()
+      return
+    if self.motion_model is not None:
+      self.n_merged_motion += self.motion_model.n_motion_msgs - n_motion_msgs
+      self.motion_model.reset_motion(*moved)
+
+    # The weights are uniform after resampling, otherwise the likelihoods of this scan are
+    # multiplied into the weights that were carried forward from earlier scans
+    np.multiply(self.weights, self.pending_weights, out=self.weights)
+    total = np.sum(self.weights)
+    if not (total > 0 and np.isfinite(total)): # Every particle disagrees with the carried weights, start over
+      np.copyto(self.weights, self.pending_weights)
+      total = np.sum(self.weights)
+    self.weights /= total
+
+    self.ess = 1.0 / np.dot(self.weights, self.weights)
+    if self.RESAMPLE_ESS_FRACTION >= 1.0 or self.ess < self.RESAMPLE_ESS_FRACTION * self.weights.shape[0]:
+      self.do_resample = True
+    else:
+      self.n_carried += 1
+      self.do_publish = True # Nothing to resample, but the pose estimate changed
+    self.update_cond.notify_all()
+    self.state_lock.release()
 
+  '''
+    Blocks until the sensor model sets do_resample or do_publish, and resets them. The wait has
+    no timeout, because a timed wait polls in python 2 and wakes up late
+      Returns: The (do_resample, do_publish) flags, both False on shutdown
+  '''
+  def wait_for_update(self):
+    self.update_cond.acquire()
+    while not (self.do_resample or self.do_publish or self.shutdown):
+      self.update_cond.wait()
+    do_resample, do_publish = self.do_resample, self.do_publish
+    self.do_resample = False
+    self.do_publish = False
+    self.update_cond.release()
+    return do_resample, do_publish
 
+  '''
+    Wakes up wait_for_update on ROS shutdown
+  '''
+  def shutdown_cb(self):
+    self.update_cond.acquire()
+    self.shutdown = True
+    self.update_cond.notify_all()
+    self.update_cond.release()
 
-    self.apply_sensor_model(self.particles, obs, self.weights)
-    self.weights[:] /= np.sum(self.weights)  # Don't know if this line is necessary after calling apply_sensor_model(), but changed so that it won't break the reference to self.weights
-    
-    self.last_laser = msg
-    self.do_resample = True
-    self.state_lock.release()
+  '''
+    Discards the sensor update that is currently running, if any, because the particles were
+    reinitialized. The caller should hold state_lock
+  '''
+  def discard_pending_update(self):
+    self.update_generation += 1
+    self.force_update = True
+
+  '''
+    Computes the observation for a laser scan
+    The angles only depend on the scan geometry, so they are cached and only
+    recomputed when the geometry changes. Ranges are gathered into a preallocated
+    buffer and NAN or 0.0 measurements are replaced by self.MAX_RANGE_METERS.
+    If self.EXCLUDE_MAX_RANGE_RAYS is set, rays at or beyond max range are masked out. They
+    keep their place in the angles so that every scan casts the same angles, which keeps the
+    cache of CachedRangeMethod valid from one scan to the next
+      msg: A sensor_msgs/LaserScan
+      Returns: A three element tuple (downsampled ranges, downsampled angles, hits) where hits is
+               a boolean mask of the rays that the sensor model should use, or None to use every ray
+  '''
+  def preprocess_scan(self, msg):
+    ranges = np.asarray(msg.ranges, dtype=np.float32) # Does not copy if msg was deserialized by numpy_msg
+
+    geometry = (msg.angle_min, msg.angle_increment, ranges.shape[0])
+    if geometry != self.scan_geometry:
+      self.scan_geometry = geometry
+      self.laser_angles = (msg.angle_min + msg.angle_increment * np.arange(ranges.shape[0])).astype(np.float32)
+      self.ray_idxs = np.arange(0, ranges.shape[0], self.LASER_RAY_STEP)
+      self.downsampled_angles = self.laser_angles[self.ray_idxs]
+      self.obs_ranges = np.zeros(self.ray_idxs.shape[0], dtype=np.float32)
+      self.invalid_rays = np.zeros(self.ray_idxs.shape[0], dtype=bool)
+      self.zero_rays = np.zeros(self.ray_idxs.shape[0], dtype=bool)
+      self.hit_rays = np.zeros(self.ray_idxs.shape[0], dtype=bool)
+      if self.BEAM_BUDGET > 0:
+        self.cache_beam_bins(ranges.shape[0])
+
+    if self.BEAM_BUDGET > 0:
+      return self.select_beams(ranges)
+
+    np.take(ranges, self.ray_idxs, out=self.obs_ranges)
+    np.isnan(self.obs_ranges, out=self.invalid_rays)
+    np.equal(self.obs_ranges, 0.0, out=self.zero_rays)
+    np.logical_or(self.invalid_rays, self.zero_rays, out=self.invalid_rays)
+    np.copyto(self.obs_ranges, self.MAX_RANGE_METERS, where=self.invalid_rays)
+
+    if self.EXCLUDE_MAX_RANGE_RAYS:
+      np.less(self.obs_ranges, self.MAX_RANGE_METERS, out=self.hit_rays)
+      return (self.obs_ranges, self.downsampled_angles, self.hit_rays)
+    return (self.obs_ranges, self.downsampled_angles, None)
+
+  '''
+    Splits the rays of a full scan into self.BEAM_BUDGET contiguous angular bins
+      n_rays: The number of rays in a full scan
+  '''
+  def cache_beam_bins(self, n_rays):
+    bin_edges = np.linspace(0, n_rays, self.BEAM_BUDGET + 1).astype(np.int64)
+    bin_len = int(np.max(np.diff(bin_edges)))
+
+    # Row i holds the indices of the rays in bin i, padded with the last ray of the bin
+    self.beam_bin_idxs = bin_edges[:-1,np.newaxis] + np.arange(bin_len)[np.newaxis,:]
+    self.beam_bin_pad = self.beam_bin_idxs >= bin_edges[1:,np.newaxis]
+    self.beam_bin_idxs = np.minimum(self.beam_bin_idxs, (bin_edges[1:] - 1)[:,np.newaxis])
+
+    self.beam_angles = self.laser_angles[(bin_edges[:-1] + bin_edges[1:] - 1) // 2]
+    self.selected_angles = np.zeros(self.BEAM_BUDGET, dtype=np.float32)
+    self.beam_ranges = np.zeros(self.BEAM_BUDGET, dtype=np.float32)
+    self.beam_hits = np.zeros(self.BEAM_BUDGET, dtype=bool)
+
+  '''
+    Selects at most self.BEAM_BUDGET informative rays from a full scan. Drops NAN and 0.0 rays
+    (and max range rays if self.EXCLUDE_MAX_RANGE_RAYS is set), then keeps the median range
+    in each angular bin, which is robust to isolated spurious returns. The median is observed
+    at the angle of the ray that measured it. If self.FIXED_BEAM_ANGLES is set, it is observed at
+    the angle of the middle ray of its bin instead, so that every scan casts the same angles, which
+    keeps the cache of CachedRangeMethod valid from one scan to the next at the cost of up to half
+    a bin of angular error
+      ranges: Numpy array of the float32 ranges of a full scan
+      Returns: A three element tuple (selected ranges, selected angles, hits) where hits is a
+               boolean mask of the bins that have a valid ray
+  '''
+  def select_beams(self, ranges):
+    bin_ranges = ranges[self.beam_bin_idxs]
+    np.copyto(bin_ranges, 0.0, where=np.isnan(bin_ranges))
+    invalid = self.beam_bin_pad | (bin_ranges <= 0.0)
+    if self.EXCLUDE_MAX_RANGE_RAYS:
+      invalid |= bin_ranges >= self.MAX_RANGE_METERS
+    else:
+      np.minimum(bin_ranges, self.MAX_RANGE_METERS, out=bin_ranges)
+
+    # Invalid rays sort last, so the median valid ray of a bin is at position (n_valid-1)//2
+    bin_ranges[invalid] = np.inf
+    order = np.argsort(bin_ranges, axis=1)
+    n_valid = bin_ranges.shape[1] - np.sum(invalid, axis=1)
+    np.greater(n_valid, 0, out=self.beam_hits)
+    bins = np.arange(self.BEAM_BUDGET)
+    median_cols = order[bins, np.maximum(n_valid - 1, 0) // 2]
+    np.copyto(self.beam_ranges, bin_ranges[bins, median_cols])
+    np.copyto(self.beam_ranges, self.MAX_RANGE_METERS, where=~self.beam_hits) # Bins without a valid ray are masked out
+
+    if self.FIXED_BEAM_ANGLES:
+      return (self.beam_ranges, self.beam_angles, self.beam_hits)
+    np.take(self.laser_angles, self.beam_bin_idxs[bins, median_cols], out=self.selected_angles)
+    return (self.beam_ranges, self.selected_angles, self.beam_hits)
     
   '''
     Compute table enumerating the probability of observing a measurement 
@@ -158,6 +425,27 @@ class SensorModel:
 
     return sensor_model_table
 
+  '''
+    Compute the likelihood of a beam endpoint landing in each cell of the map, as in the
+    likelihood field model in CH 6.4 of Probabilistic Robotics
+    map_msg: A nav_msgs/OccupancyGrid msg containing the map
+    Returns a flattened numpy array with map_msg.info.height*map_msg.info.width+1 elements,
+    where the last element is the likelihood of an endpoint outside of the map
+  '''
+  def precompute_likelihood_field(self, map_msg):
+    from scipy import ndimage # Imported here so that scipy is only needed by the likelihood field model
+
+    array_255 = np.array(map_msg.data).reshape((map_msg.info.height, map_msg.info.width))
+
+    # Distance in meters from every cell to the nearest occupied cell. Same convention as the
+    # permissible region and the range methods: only cells with value 0 are free, so unknown (-1) cells are obstacles
+    dist = ndimage.distance_transform_edt(array_255 == 0) * map_msg.info.resolution
+
+    likelihood_field = np.zeros(dist.size + 1)
+    likelihood_field[:-1] = LF_Z_HIT * np.exp(-0.5 * np.square(dist.ravel() / LF_SIGMA_HIT)) + LF_Z_RAND
+    likelihood_field[-1] = LF_Z_RAND
+    return likelihood_field
+
   '''
     Updates the particle weights in-place based on the observed laser scan
       proposal_dist: The particles
@@ -165,23 +453,194 @@ class SensorModel:
       weights: The weights of each particle
   '''
   def apply_sensor_model(self, proposal_dist, obs, weights):
+    if self.SENSOR_MODEL_TYPE == 'likelihood_field':
+      self.apply_likelihood_field(proposal_dist, obs, weights)
+      return
         
-    obs_ranges = obs[0]
-    obs_angles = obs[1]
+    obs_ranges, obs_angles, hits = obs
     num_rays = obs_angles.shape[0]
     
-    # Only allocate buffers once to avoid slowness
-    if not isinstance(self.queries, np.ndarray):
+    # Only allocate buffers when the number of particles changes to avoid slowness
+    if not isinstance(self.queries, np.ndarray) or self.queries.shape[0] != proposal_dist.shape[0]:
       self.queries = np.zeros((proposal_dist.shape[0],3), dtype=np.float32)
       self.ranges = np.zeros(num_rays*proposal_dist.shape[0], dtype=np.float32)
+      self.unique_weights = np.zeros(proposal_dist.shape[0])
+      self.fine_weights = np.zeros(proposal_dist.shape[0])
+    if self.ranges.shape[0] < num_rays*proposal_dist.shape[0]:
+      self.ranges = np.zeros(num_rays*proposal_dist.shape[0], dtype=np.float32) # Observations can have more rays than before
     
     self.queries[:,:] = proposal_dist[:,:]
+    self.n_cast = 0
+    labels = None
+    if self.chosen_idxs is not None and self.chosen_idxs.shape[0] == proposal_dist.shape[0]:
+      labels = self.chosen_idxs # Particles that were copied from the same particle are the same pose
+
+    if 0.0 < self.CASCADE_FRACTION < 1.0:
+      self.apply_cascade(labels, obs_ranges, obs_angles, hits, weights)
+    else:
+      self.eval_queries(self.queries, labels, obs_ranges, obs_angles, hits, weights)
+
+    # Squash weights to prevent too much peakiness. Log-likelihoods were already squashed by the table
+    if not self.LOG_LIKELIHOOD:
+      np.power(weights, INV_SQUASH_FACTOR, weights)
+
+  '''
+    Ray casts the queries and evaluates the sensor model for them
+      queries: Numpy array of dimension (N,3) of float32 poses
+      labels: Numpy array of dimension (N,) where queries with the same label are the same pose,
+              None if the poses are not known to repeat
+      obs_ranges: The observed ranges
+      obs_angles: The angles of the observed ranges
+      hits: Boolean mask of the rays to evaluate the sensor model with, None for every ray
+      weights: Numpy array of dimension (N,) that is filled with the likelihood (or squashed
+               log-likelihood in log-likelihood mode) of each query
+  '''
+  def eval_queries(self, queries, labels, obs_ranges, obs_angles, hits, weights):
+    num_rays = obs_angles.shape[0]
+
+    # Resampling leaves many exact copies of the same pose, only cast each of them once
+    unique_idxs, inverse = (None, None) if labels is None else self.find_unique_labels(labels)
+    if unique_idxs is None:
+      self.n_cast += queries.shape[0]
+      ranges = self.ranges[:queries.shape[0]*num_rays]
+
+      # Raycasting to get expected measurements
+      self.range_method.calc_range_repeat_angles(queries, obs_angles, ranges)
+
+      # Evaluate the sensor model
+      self.eval_sensor_model(obs_ranges, ranges, weights, num_rays, queries.shape[0], hits)
+    else:
+      self.n_cast += unique_idxs.shape[0]
+      ranges = self.ranges[:unique_idxs.shape[0]*num_rays]
+      unique_weights = self.unique_weights[:unique_idxs.shape[0]]
+      self.range_method.calc_range_repeat_angles(queries[unique_idxs], obs_angles, ranges)
+      self.eval_sensor_model(obs_ranges, ranges, unique_weights, num_rays, unique_idxs.shape[0], hits)
+
+      # Scatter the likelihood of each unique pose back to all of its copies
+      np.take(unique_weights, inverse, out=weights)
+
+  '''
+    Evaluates the sensor model for ray cast expected ranges. In log-likelihood mode the squashed
+    log-probabilities of the rays are summed, otherwise the range method multiplies their probabilities
+      obs_ranges: The observed ranges
+      ranges: The expected ranges, num_rays consecutive ranges for each particle
+      weights: Numpy array of dimension (num_particles,) that is filled with the result
+      num_rays: The number of rays per particle
+      num_particles: The number of particles
+      hits: Boolean mask of the rays to evaluate the sensor model with, None for every ray
+  '''
+  def eval_sensor_model(self, obs_ranges, ranges, weights, num_rays, num_particles, hits=None):
+    if hits is not None:
+      # Only the rays that hit something are scored, gather their expected ranges
+      n_hits = np.count_nonzero(hits)
+      if self.hit_ranges is None or self.hit_ranges.shape[0] < n_hits*num_particles:
+        self.hit_ranges = np.zeros(num_rays*num_particles, dtype=np.float32)
+      hit_ranges = self.hit_ranges[:n_hits*num_particles]
+      np.compress(hits, ranges[:num_rays*num_particles].reshape((num_particles, num_rays)), axis=1,
+                  out=hit_ranges.reshape((num_particles, n_hits)))
+      obs_ranges = obs_ranges[hits]
+      ranges = hit_ranges
+      num_rays = n_hits
+
+    if not self.LOG_LIKELIHOOD:
+      self.range_method.eval_sensor_model(obs_ranges, ranges, weights, num_rays, num_particles)
+      return
+
+    # Clip and truncate to table indices the same way the range methods do
+    max_px = self.log_sensor_model_table.shape[0] - 1
+    obs_px = np.clip(obs_ranges / self.map_info.resolution, 0, max_px).astype(np.int64)
+    expected_px = np.clip(ranges[:num_rays*num_particles] / self.map_info.resolution, 0, max_px).astype(np.int64)
+    np.sum(self.log_sensor_model_table[obs_px, expected_px.reshape((num_particles, num_rays))],
+           axis=1, dtype=np.float64, out=weights)
 
-    # Raycasting to get expected measurements
-    self.range_method.calc_range_repeat_angles(self.queries, obs_angles, self.ranges)
+  '''
+    Scores every particle with every CASCADE_COARSE_STEP-th ray first, then rescores
+    only the CASCADE_FRACTION best of them with all of the rays
+      labels: Numpy array of dimension (N,) where particles with the same label are the same pose,
+              None if the poses are not known to repeat
+      obs_ranges: The observed ranges
+      obs_angles: The angles of the observed ranges
+      hits: Boolean mask of the rays to evaluate the sensor model with, None for every ray
+      weights: The weights of each particle
+  '''
+  def apply_cascade(self, labels, obs_ranges, obs_angles, hits, weights):
+    coarse_ranges = np.ascontiguousarray(obs_ranges[::CASCADE_COARSE_STEP])
+    coarse_angles = np.ascontiguousarray(obs_angles[::CASCADE_COARSE_STEP])
+    coarse_hits = None
+    n_rays = obs_angles.shape[0]
+    n_coarse_rays = coarse_angles.shape[0]
+    if hits is not None:
+      coarse_hits = np.ascontiguousarray(hits[::CASCADE_COARSE_STEP])
+      n_rays = np.count_nonzero(hits)
+      n_coarse_rays = np.count_nonzero(coarse_hits)
+    if n_coarse_rays == 0:
+      # None of the coarse rays hit anything, so they cannot rank the particles
+      self.eval_queries(self.queries, labels, obs_ranges, obs_angles, hits, weights)
+      return
+    self.eval_queries(self.queries, labels, coarse_ranges, coarse_angles, coarse_hits, weights)
+
+    # A coarse score is a product over fewer rays, so bring it to the scale of a score over all of the rays
+    if self.LOG_LIKELIHOOD:
+      np.multiply(weights, n_rays / n_coarse_rays, weights)
+    else:
+      np.power(weights, n_rays / n_coarse_rays, weights)
+
+    n_particles = self.queries.shape[0]
+    n_fine = int(np.ceil(self.CASCADE_FRACTION * n_particles))
+    fine_idxs = np.argpartition(weights, n_particles - n_fine)[n_particles - n_fine:]
+    fine_weights = self.fine_weights[:n_fine]
+    fine_labels = labels[fine_idxs] if labels is not None else None
+    self.eval_queries(self.queries[fine_idxs], fine_labels, obs_ranges, obs_angles, hits, fine_weights)
+    weights[fine_idxs] = fine_weights
+
+  '''
+    Finds the distinct labels without sorting, by scattering the index of each label into a table
+      labels: Numpy array of dimension (N,) of nonnegative integer labels
+      Returns: (unique_idxs, inverse) where labels[unique_idxs] are the distinct labels and
+               labels == labels[unique_idxs][inverse], or (None, None) if too many of the labels
+               are distinct for casting only the unique poses to pay off
+  '''
+  def find_unique_labels(self, labels):
+    slots = np.arange(labels.shape[0])
+    label_slots = np.zeros(np.max(labels) + 1, dtype=np.int64)
+    label_slots[labels] = slots # Of the slots with the same label, one is written last and stands for all of them
+    rep_slots = label_slots[labels]
+    is_rep = rep_slots == slots
+    unique_idxs = np.flatnonzero(is_rep)
+    if unique_idxs.shape[0] > UNIQUE_CAST_MAX_FRACTION * labels.shape[0]:
+      return None, None
+    inverse = (np.cumsum(is_rep) - 1)[rep_slots]
+    return unique_idxs, inverse
+
+  '''
+    Updates the particle weights in-place by looking up the likelihood of each beam endpoint
+    in the precomputed likelihood field. Needs no ray casting
+      proposal_dist: The particles
+      obs: The most recent observation
+      weights: The weights of each particle
+  '''
+  def apply_likelihood_field(self, proposal_dist, obs, weights):
+    # Max range readings have no endpoint
+    hits = obs[0] < self.MAX_RANGE_METERS
+    obs_ranges_px = obs[0][hits] / self.map_info.resolution
+    obs_angles = obs[1][hits]
 
-    # Evaluate the sensor model
-    self.range_method.eval_sensor_model(obs_ranges, self.ranges, weights, num_rays, proposal_dist.shape[0])
+    map_poses = np.array(proposal_dist, dtype=np.float64)
+    Utils.world_to_map(map_poses, self.map_info)
+
+    # Project the endpoint of every beam of every particle into the map
+    beam_theta = map_poses[:,2,np.newaxis] + obs_angles[np.newaxis,:]
+    xs = np.floor(map_poses[:,0,np.newaxis] + obs_ranges_px * np.cos(beam_theta)).astype(np.int64)
+    ys = np.floor(map_poses[:,1,np.newaxis] + obs_ranges_px * np.sin(beam_theta)).astype(np.int64)
+    flat_idxs = ys * self.map_info.width + xs
+    flat_idxs[(xs < 0) | (xs >= self.map_info.width) | (ys < 0) | (ys >= self.map_info.height)] = self.likelihood_field.shape[0] - 1
+
+    if self.LOG_LIKELIHOOD:
+      # The field holds squashed log-likelihoods
+      np.sum(self.likelihood_field[flat_idxs], axis=1, out=weights)
+      return
+
+    np.prod(self.likelihood_field[flat_idxs], axis=1, out=weights)
 
     # Squash weights to prevent too much peakiness
     np.power(weights, INV_SQUASH_FACTOR, weights)
@@ -202,6 +661,13 @@ if __name__ == '__main__':
   laser_ray_step = int(rospy.get_param("~laser_ray_step")) # Step for downsampling laser scans
   exclude_max_range_rays = bool(rospy.get_param("~exclude_max_range_rays")) # Whether to exclude rays that are beyond the max range
   max_range_meters = float(rospy.get_param("~max_range_meters")) # The max range of the laser               
+  range_method_type = rospy.get_param("~range_method", "cddt") # The ray casting backend
+  sensor_model_type = rospy.get_param("~sensor_model_type", "beam") # Whether to use the beam or likelihood field model
+  range_cache_size = int(rospy.get_param("~range_cache_size", 0)) # Number of range vectors to memoize, 0 disables the cache
+  cascade_fraction = float(rospy.get_param("~cascade_fraction", 0.0)) # Fraction of particles rescored with every ray, 0 disables the cascade
+  beam_budget = int(rospy.get_param("~beam_budget", 0)) # Number of informative rays to select per scan, 0 uses laser_ray_step
+  log_likelihood = bool(rospy.get_param("~log_likelihood", False)) # Whether to sum log-probabilities instead of multiplying probabilities
+  n_workers = int(rospy.get_param("~n_workers", 1)) # Number of threads that the sensor update is sharded across
 
   print 'Bag path: ' + bag_path
 
@@ -234,7 +700,10 @@ if __name__ == '__main__':
   
   print 'Initializing sensor model'
   sm = SensorModel(scan_topic, laser_ray_step, exclude_max_range_rays, 
-                   max_range_meters, map_msg, particles, weights)
+                   max_range_meters, map_msg, particles, weights,
+                   range_method_type=range_method_type, sensor_model_type=sensor_model_type,
+                   range_cache_size=range_cache_size, cascade_fraction=cascade_fraction,
+                   beam_budget=beam_budget, log_likelihood=log_likelihood, n_workers=n_workers)
   
   # Give time to get setup
   rospy.sleep(1.0)
@@ -255,9 +724,9 @@ if __name__ == '__main__':
     pub_laser.publish(laser_msg)
     rospy.sleep(1.0)
  
-  rospy.sleep(1.0) # Make sure there's enough time for laserscan to get lock
-  
   print 'Going to wait for sensor model to finish'
+  while not sm.do_resample:
+    rospy.sleep(0.1)
   sm.state_lock.acquire()
   print 'Done, preparing to plot'
   weights = weights.reshape((angle_step, -1))